@@ -58,6 +58,7 @@ class ModelParams(ParamGroup):
         self.min_visibility = 1
         self.initialisation = "colmap"
         self.start_gaussians = 1000000
+        self.texture_precision = "float32"
         super().__init__(parser, "Loading Parameters", sentinel)
 
     def extract(self, args):
@@ -70,6 +71,10 @@ class PipelineParams(ParamGroup):
         self.convert_SHs_python = True
         self.compute_cov3D_python = False
         self.debug = False
+        self.depth_cache_mb = 2048
+        self.frustum_culling = False
+        self.rasterizer = "cuda"
+        self.shadow_map_padding = "zeros"
         super().__init__(parser, "Pipeline Parameters")
 
 class OptimizationParams(ParamGroup):
@@ -94,6 +99,8 @@ class OptimizationParams(ParamGroup):
         self.random_background = False
         self.textured_render = False
         self.max_gaussians = 1000000
+        self.min_views = 0
+        self.visibility_index_interval = 1000
         super().__init__(parser, "Optimization Parameters")
 
 def get_combined_args(parser : ArgumentParser):
@@ -0,0 +1,141 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import os
+import json
+import time
+import torch
+from random import randint
+from tqdm import tqdm
+from argparse import ArgumentParser
+from arguments import ModelParams, PipelineParams, get_combined_args
+from depth_images import calibrate_depth
+from gaussian_renderer import render, GaussianModel
+from scene import Scene
+from scene.camera_index import CameraIndex
+from textured_render import depth_cache, enable_compiled_kernels, prerender_depth, textured_render_multicam
+from utils.general_utils import farthest_point_down_sample, safe_state
+from utils.image_utils import psnr
+from utils.loss_utils import l1_loss, ssim
+
+def textured_targets(views, texture_views, gaussians, pipeline, background, blend_mode):
+    """
+    Textured renders of the training views, each one textured without its own image, kept on
+    the cpu with their masks.
+    """
+    targets = []
+    with torch.no_grad():
+        for view in tqdm(views, desc="Textured targets"):
+            rendering_pkg = textured_render_multicam(view, texture_views, gaussians, pipeline, background, in_training=True, blend_mode=blend_mode, outputs=["render_textured","render_textured_mask"])
+            targets.append((rendering_pkg["render_textured"].clamp(0,1).cpu(), rendering_pkg["render_textured_mask"].cpu()))
+    return targets
+
+def bake(gaussians, views, targets, pipeline, background, iterations, feature_lr, lambda_dssim):
+    """
+    Fits the SH coefficients of gaussians to the textured targets, the geometry is left as is.
+    """
+    for tensor in [gaussians._xyz, gaussians._scaling, gaussians._rotation, gaussians._opacity]:
+        tensor.requires_grad_(False)
+    gaussians.active_sh_degree = gaussians.max_sh_degree
+
+    optimizer = torch.optim.Adam([
+        {'params': [gaussians._features_dc], 'lr': feature_lr},
+        {'params': [gaussians._features_rest], 'lr': feature_lr / 20.0},
+    ], lr=0.0, eps=1e-15)
+
+    progress_bar = tqdm(range(iterations), desc="Baking")
+    for iteration in progress_bar:
+        idx = randint(0, len(views)-1)
+        target, mask = (t.cuda() for t in targets[idx])
+
+        image = render(views[idx], gaussians, pipeline, background)["render"]
+        loss = (1.0 - lambda_dssim) * l1_loss(image*mask, target*mask) + lambda_dssim * (1.0 - ssim(image*mask, target*mask))
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+        if iteration % 10 == 0:
+            progress_bar.set_postfix({"Loss": f"{loss.item():.5f}"})
+
+def evaluate(views, render_view):
+    """
+    Mean PSNR against the ground truth images and mean time per view of render_view.
+    """
+    psnrs = []
+    elapsed = 0.0
+    with torch.no_grad():
+        for view in views:
+            torch.cuda.synchronize()
+            start = time.perf_counter()
+            image = render_view(view)
+            torch.cuda.synchronize()
+            elapsed += time.perf_counter() - start
+            psnrs.append(psnr(image.clamp(0,1), view.original_image.cuda()).mean().item())
+    return {"psnr": sum(psnrs)/len(psnrs), "ms_per_view": 1000*elapsed/len(views)}
+
+def bake_sets(dataset : ModelParams, iteration : int, pipeline : PipelineParams, blend_mode, train_images, iterations, feature_lr, lambda_dssim):
+    gaussians = GaussianModel(dataset.sh_degree)
+    scene = Scene(dataset, gaussians, load_iteration=iteration, shuffle=False)
+    calibrate_depth(scene)
+
+    bg_color = [1,1,1] if dataset.white_background else [0, 0, 0]
+    background = torch.tensor(bg_color, dtype=torch.float32, device="cuda")
+
+    train_views = scene.getTrainCameras()
+    prerender_depth(train_views, gaussians, pipeline, background)
+    texture_views = farthest_point_down_sample(torch.stack([c.camera_center.cpu() for c in train_views]), train_images)
+    texture_views = CameraIndex([train_views[i] for i in texture_views])
+
+    # The live path on unseen views when there are any, on the training views otherwise
+    eval_views = scene.getTestCameras() or train_views
+    in_training = len(scene.getTestCameras()) == 0
+    report = {"iteration": scene.loaded_iter, "blend_mode": blend_mode, "num_texture_views": len(texture_views), "num_eval_views": len(eval_views)}
+
+    report["splat"] = evaluate(eval_views, lambda view: render(view, gaussians, pipeline, background)["render"])
+    report["textured"] = evaluate(eval_views, lambda view: textured_render_multicam(view, texture_views, gaussians, pipeline, background, in_training=in_training, blend_mode=blend_mode, outputs=["render_textured"])["render_textured"])
+    print("Depth cache:", depth_cache.stats())
+
+    targets = textured_targets(train_views, texture_views, gaussians, pipeline, background, blend_mode)
+    bake(gaussians, train_views, targets, pipeline, background, iterations, feature_lr, lambda_dssim)
+    gaussians.bump_version()
+
+    report["baked"] = evaluate(eval_views, lambda view: render(view, gaussians, pipeline, background)["render"])
+    report["speedup"] = report["textured"]["ms_per_view"] / report["baked"]["ms_per_view"]
+
+    baked_path = os.path.join(dataset.model_path, "baked", "iteration_{}".format(scene.loaded_iter))
+    gaussians.save_ply(os.path.join(baked_path, "point_cloud.ply"))
+    with open(os.path.join(baked_path, "report.json"), "w") as f:
+        json.dump(report, f, indent=True)
+
+    for approach in ["splat", "textured", "baked"]:
+        print(f"{approach:>9}: PSNR {report[approach]['psnr']:.2f} dB, {report[approach]['ms_per_view']:.1f} ms per view")
+
+if __name__ == "__main__":
+    # Set up command line argument parser
+    parser = ArgumentParser(description="Bakes textured rendering into the SH coefficients of a trained model")
+    model = ModelParams(parser, sentinel=True)
+    pipeline = PipelineParams(parser)
+    parser.add_argument("--iteration", default=-1, type=int)
+    parser.add_argument("--blend_mode", default="scores", type=str)
+    parser.add_argument("--train_images", default=1000, type=int)
+    parser.add_argument("--bake_iterations", default=7000, type=int)
+    parser.add_argument("--feature_lr", default=0.0025, type=float)
+    parser.add_argument("--lambda_dssim", default=0.2, type=float)
+    parser.add_argument("--quiet", action="store_true")
+    parser.add_argument("--compile", action="store_true")
+    args = get_combined_args(parser)
+    print("Baking " + args.model_path)
+
+    # Initialize system state (RNG)
+    safe_state(args.quiet)
+    enable_compiled_kernels(args.compile)
+
+    bake_sets(model.extract(args), args.iteration, pipeline.extract(args), args.blend_mode, args.train_images, args.bake_iterations, args.feature_lr, args.lambda_dssim)
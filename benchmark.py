@@ -0,0 +1,363 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import math
+import time
+import torch
+import numpy as np
+from argparse import ArgumentParser
+from arguments import PipelineParams
+from blending import BLEND_MODES, StreamingBlend, blend_stack
+from depth_images import depth_image_to_point_cloud
+from gaussian_renderer import CUDA_RASTERIZER_FOUND, render
+from scene.gaussian_model import GaussianModel
+from textured_render import TextureStackBatches, enable_compiled_kernels, texture_pixels, textured_render
+from utils.general_utils import inverse_sigmoid
+from utils.graphics_utils import getWorld2View2, getProjectionMatrix, fov2focal
+from utils.image_utils import psnr
+from utils.texture_pyramid import build_packed_scales
+
+class SyntheticCamera:
+    """
+    Pinhole camera at position looking at the origin, textured with a procedural pattern on the
+    plane z=0. Depth is computed analytically, so no Gaussian model or rasterizer is needed.
+    """
+    def __init__(self, uid, position, width, height, fov, device="cpu", texture_dtype=torch.float32):
+        self.uid = uid
+        self.split = "synthetic"
+        self.image_width = width
+        self.image_height = height
+        self.FoVx = fov
+        self.FoVy = 2*math.atan(math.tan(fov/2)*height/width)
+
+        position = np.asarray(position, dtype=np.float64)
+        forward = -position/np.linalg.norm(position)
+        right = np.cross(forward, np.array([0.0,0.0,1.0]))
+        right /= np.linalg.norm(right)
+        down = np.cross(forward, right)
+        R = np.stack([right, down, forward], axis=1)
+        T = -R.T @ position
+
+        self.world_view_transform = torch.tensor(getWorld2View2(R, T)).transpose(0,1).to(device)
+        self.projection_matrix = getProjectionMatrix(znear=0.01, zfar=100.0, fovX=self.FoVx, fovY=self.FoVy).transpose(0,1).to(device)
+        self.full_proj_transform = self.world_view_transform @ self.projection_matrix
+        self.camera_center = torch.tensor(position, dtype=torch.float32, device=device)
+        self.proj_mat = self.get_proj_mat().to(device)
+
+        depth, points = self.plane_depth(device)
+        self.original_image = plane_texture(points).permute(2,0,1).contiguous()
+        self.image_scales = build_packed_scales(self.original_image, dtype=texture_dtype)
+        self.rendered_depth_scales = build_packed_scales(depth, dtype=texture_dtype)
+        self.rendered_depth = self.rendered_depth_scales[0]
+
+    def get_proj_mat(self):
+        fx = fov2focal(self.FoVx,self.image_width)
+        fy = fov2focal(self.FoVy,self.image_height)
+        return torch.tensor([
+            [fx,0,self.image_width/2],
+            [0,fy,self.image_height/2],
+            [0,0,1]
+        ])
+
+    def plane_depth(self, device):
+        """
+        View space depth of the plane z=0 at every pixel, and the hit points in world space.
+        """
+        fx = fov2focal(self.FoVx,self.image_width)
+        fy = fov2focal(self.FoVy,self.image_height)
+        y, x = torch.meshgrid(
+            torch.arange(self.image_height,device=device).float(),
+            torch.arange(self.image_width,device=device).float(),
+            indexing="ij"
+        )
+        rays = torch.stack([(x-self.image_width/2)/fx, (y-self.image_height/2)/fy, torch.ones_like(x)], dim=2)
+        cam_to_world = torch.linalg.inv(self.world_view_transform.T)
+        world_rays = rays @ cam_to_world[:3,:3].T
+        depth = -self.camera_center[2] / world_rays[...,2]
+        points = self.camera_center + world_rays*depth.unsqueeze(2)
+        return depth.unsqueeze(0), points
+
+def plane_texture(points):
+    x, y = points[...,0], points[...,1]
+    return torch.stack([
+        0.5+0.5*torch.sin(7*x)*torch.cos(5*y),
+        0.5+0.5*torch.sin(3*x+11*y),
+        0.5+0.5*torch.cos(13*x-2*y),
+    ], dim=2).clamp(0,1)
+
+def synthetic_cameras(num_cameras, width, height, device, texture_dtype=torch.float32, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    cameras = []
+    for i in range(num_cameras):
+        angle = 2*math.pi*i/num_cameras
+        height_offset = 0.2*torch.rand(1, generator=generator).item()
+        position = [2*math.cos(angle), 2*math.sin(angle), 1.5+height_offset]
+        cameras.append(SyntheticCamera(i, position, width, height, math.radians(60), device, texture_dtype))
+    return cameras
+
+def blend_synthetic(viewpoint, texture_cameras, blend_mode, score_mode, batch_size):
+    depth = viewpoint.rendered_depth
+    render_points = depth_image_to_point_cloud(depth, viewpoint)
+    opacity = torch.ones_like(depth)
+    texture_stacks = TextureStackBatches(texture_cameras, 0, batch_size)
+    render_textured, render_textured_mask, _, _, _ = texture_pixels(
+        render_points, opacity, viewpoint, texture_stacks, blend_mode, score_mode, [], track_in_frame=False
+    )
+    shape = (viewpoint.image_height, viewpoint.image_width)
+    return render_textured.reshape((3,*shape)), render_textured_mask.reshape((1,*shape))
+
+def blend_synthetic_loop(viewpoint, texture_cameras, blend_mode, score_mode):
+    """
+    Reference for blend_synthetic: samples the texture cameras one at a time with the
+    per-camera textured_render and blends the resulting stacks in one call.
+    """
+    render_points = depth_image_to_point_cloud(viewpoint.rendered_depth, viewpoint)
+    colors, masks, scores = [], [], []
+    for camera in texture_cameras:
+        color, not_in_shadow, in_frame, score = textured_render(render_points, viewpoint, camera, 0, score_mode=score_mode)
+        mask = not_in_shadow.reshape((1,-1)) * in_frame.reshape((1,-1))
+        colors.append(color.reshape((3,-1)))
+        masks.append(mask)
+        scores.append(score.reshape((1,-1)) * mask)
+    image, mask = blend_stack(blend_mode, torch.stack(colors), torch.stack(masks), torch.stack(scores))
+    shape = (viewpoint.image_height, viewpoint.image_width)
+    return image.reshape((3,*shape)), mask.reshape((1,*shape))
+
+def texture_memory_mb(cameras):
+    return sum(level.numel()*level.element_size() for cam in cameras for level in cam.image_scales + cam.rendered_depth_scales) / 1024**2
+
+def time_function(function, device, repeats=10):
+    """
+    Mean time of function over repeats calls, after one warm up call (which includes any
+    compilation). Returns the time and the result of the last call.
+    """
+    result = function()
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = function()
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats, result
+
+def benchmark_precision(args):
+    """
+    Blends the same synthetic texture cameras stored in float32 and in args.precision, and
+    reports texture memory, blend time and the PSNR of the reduced precision blend.
+    """
+    viewpoint = SyntheticCamera(-1, [0.3, -2.2, 1.6], args.width, args.height, math.radians(60), args.device)
+
+    results = {}
+    for precision in ["float32", *args.precision]:
+        cameras = synthetic_cameras(args.num_cameras, args.width, args.height, args.device, getattr(torch, precision))
+        start = time.perf_counter()
+        with torch.no_grad():
+            image, mask = blend_synthetic(viewpoint, cameras, args.blend_mode, args.score_mode, args.batch_size)
+        elapsed = time.perf_counter() - start
+        results[precision] = (image, mask, texture_memory_mb(cameras), elapsed)
+
+    reference, reference_mask, _, _ = results["float32"]
+    for precision, (image, mask, memory, elapsed) in results.items():
+        line = f"{precision:>9}: textures {memory:8.2f} MB, blend {elapsed*1000:8.1f} ms"
+        if precision != "float32":
+            value = psnr((image*reference_mask).unsqueeze(0), (reference*reference_mask).unsqueeze(0)).item()
+            line += f", PSNR vs float32 {value:.2f} dB"
+            if value < args.min_psnr:
+                line += f" (below {args.min_psnr} dB)"
+        print(line)
+
+def benchmark_compile(args):
+    """
+    Times the blend of synthetic texture cameras with eager and with torch.compile'd kernels.
+    """
+    if not hasattr(torch, "compile"):
+        print("torch.compile is not available in this version of PyTorch, both runs are eager")
+
+    viewpoint = SyntheticCamera(-1, [0.3, -2.2, 1.6], args.width, args.height, math.radians(60), args.device)
+    cameras = synthetic_cameras(args.num_cameras, args.width, args.height, args.device)
+
+    timings = {}
+    with torch.no_grad():
+        for compiled in [False, True]:
+            enable_compiled_kernels(compiled)
+            timings[compiled] = time_function(
+                lambda: blend_synthetic(viewpoint, cameras, args.blend_mode, args.score_mode, args.batch_size),
+                args.device, args.repeats
+            )
+    enable_compiled_kernels(False)
+
+    eager_time, (eager_image, _) = timings[False]
+    compiled_time, (compiled_image, _) = timings[True]
+    print(f"   eager: {eager_time*1000:8.1f} ms")
+    print(f"compiled: {compiled_time*1000:8.1f} ms ({eager_time/compiled_time:.2f}x)")
+    print(f"max difference: {(eager_image-compiled_image).abs().max().item():.2e}")
+
+def benchmark_batched(args):
+    """
+    Checks that the batched sampling and streamed blending of texture cameras agree with the
+    per-camera textured_render loop, for every registered blend mode.
+    """
+    viewpoint = SyntheticCamera(-1, [0.3, -2.2, 1.6], args.width, args.height, math.radians(60), args.device)
+    cameras = synthetic_cameras(args.num_cameras, args.width, args.height, args.device)
+
+    failed = []
+    with torch.no_grad():
+        for blend_mode in BLEND_MODES:
+            batched_time, (batched_image, batched_mask) = time_function(
+                lambda: blend_synthetic(viewpoint, cameras, blend_mode, args.score_mode, args.batch_size), args.device, args.repeats
+            )
+            loop_time, (loop_image, loop_mask) = time_function(
+                lambda: blend_synthetic_loop(viewpoint, cameras, blend_mode, args.score_mode), args.device, args.repeats
+            )
+            image_difference = (batched_image-loop_image).abs().max().item()
+            mask_difference = (batched_mask-loop_mask).abs().max().item()
+            line = f"{blend_mode:>15}: batched {batched_time*1000:8.1f} ms, loop {loop_time*1000:8.1f} ms"
+            line += f", max difference image {image_difference:.2e} mask {mask_difference:.2e}"
+            if max(image_difference, mask_difference) > args.tolerance:
+                failed.append(blend_mode)
+                line += f" (above {args.tolerance:.0e})"
+            print(line)
+
+    if failed:
+        raise SystemExit(f"Batched and per-camera textured renders differ for {', '.join(failed)}")
+
+def alpha_blend_loop(colors, masks):
+    """
+    Alpha compositing one camera at a time, as textured_render_per_gaussian used to do it.
+    """
+    color = torch.zeros_like(colors[0])
+    T = torch.ones_like(masks[0])
+    for i in range(len(masks)):
+        color = color + colors[i] * masks[i] * T
+        T = T*(1-masks[i])
+    return color, 1-T
+
+def benchmark_blend(args):
+    """
+    Times every registered blend mode on random stacks, blended in one call and streamed in
+    batches, and checks that both give the same result.
+    """
+    generator = torch.Generator().manual_seed(0)
+    num_pixels = args.width*args.height
+    colors = torch.rand((args.num_cameras,3,num_pixels), generator=generator).to(args.device)
+    masks = (torch.rand((args.num_cameras,1,num_pixels), generator=generator) > 0.3).float().to(args.device)
+    scores = torch.rand((args.num_cameras,1,num_pixels), generator=generator).to(args.device) * masks
+
+    def streamed(blend_mode):
+        blend = StreamingBlend(blend_mode, num_pixels, args.device, track_in_frame=False)
+        for i in range(0, args.num_cameras, args.batch_size):
+            batch = slice(i, i+args.batch_size)
+            blend.update(colors[batch], masks[batch], None, scores[batch])
+        return blend.result()
+
+    with torch.no_grad():
+        for blend_mode in BLEND_MODES:
+            stack_time, (stack_image, _) = time_function(lambda: blend_stack(blend_mode, colors, masks, scores), args.device, args.repeats)
+            stream_time, (stream_image, _) = time_function(lambda: streamed(blend_mode), args.device, args.repeats)
+            difference = (stack_image-stream_image).abs().max().item()
+            print(f"{blend_mode:>15}: stack {stack_time*1000:8.2f} ms, streamed {stream_time*1000:8.2f} ms, max difference {difference:.2e}")
+
+        loop_time, (loop_image, _) = time_function(lambda: alpha_blend_loop(colors, masks), args.device, args.repeats)
+        stack_image, _ = blend_stack("alpha", colors, masks, scores)
+        difference = (loop_image-stack_image).abs().max().item()
+        print(f"{'alpha (loop)':>15}: {loop_time*1000:8.2f} ms, max difference to cumprod {difference:.2e}")
+
+def random_gaussians(num_gaussians, device, sh_degree=0, seed=0):
+    """
+    num_gaussians small random Gaussians in a slab around the plane z=0 seen by SyntheticCamera.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    def rand(*shape):
+        return torch.rand(shape, generator=generator)
+
+    gaussians = GaussianModel(sh_degree)
+    gaussians.active_sh_degree = sh_degree
+    gaussians._xyz = ((rand(num_gaussians,3)*2-1) * torch.tensor([1.5,1.5,0.2])).to(device).requires_grad_(True)
+    gaussians._scaling = torch.log(0.002 + 0.02*rand(num_gaussians,3)).to(device).requires_grad_(True)
+    gaussians._rotation = torch.randn((num_gaussians,4), generator=generator).to(device).requires_grad_(True)
+    gaussians._opacity = inverse_sigmoid(0.1 + 0.8*rand(num_gaussians,1)).to(device).requires_grad_(True)
+    gaussians._features_dc = (0.5*torch.randn((num_gaussians,1,3), generator=generator)).to(device).requires_grad_(True)
+    gaussians._features_rest = torch.zeros((num_gaussians,(sh_degree+1)**2-1,3)).to(device).requires_grad_(True)
+    return gaussians
+
+def benchmark_rasterizer(args):
+    """
+    Throughput of the rasterizer backends on random Gaussians, forward only and forward with
+    backward, and the largest difference of the PyTorch rasterizer to the CUDA one.
+    """
+    pipe = args.pipe
+    camera = SyntheticCamera(-1, [0.3, -2.2, 1.6], args.width, args.height, math.radians(60), args.device)
+    background = torch.zeros(3, device=args.device)
+    backends = ["torch"]
+    if CUDA_RASTERIZER_FOUND and torch.device(args.device).type == "cuda":
+        backends.append("cuda")
+
+    for num_gaussians in args.num_gaussians:
+        gaussians = random_gaussians(num_gaussians, args.device)
+        images = {}
+        for backend in backends:
+            pipe.rasterizer = backend
+            with torch.no_grad():
+                forward_time, render_pkg = time_function(lambda: render(camera, gaussians, pipe, background), args.device, args.repeats)
+            images[backend] = render_pkg["render"]
+
+            def forward_backward():
+                render_pkg = render(camera, gaussians, pipe, background)
+                (render_pkg["render"].mean() + render_pkg["render_depth"].mean()).backward()
+            backward_time, _ = time_function(forward_backward, args.device, args.repeats)
+
+            line = f"{num_gaussians:>8} Gaussians, {backend:>5}: forward {forward_time*1000:9.1f} ms ({num_gaussians/forward_time/1e6:6.2f} M/s)"
+            line += f", forward+backward {backward_time*1000:9.1f} ms ({num_gaussians/backward_time/1e6:6.2f} M/s)"
+            print(line)
+        if len(images) > 1:
+            print(f"{'':>8} max difference torch to cuda: {(images['torch']-images['cuda']).abs().max().item():.2e}")
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmarks of the textured rendering kernels on synthetic cameras")
+    parser.add_argument("--device", default="cpu", type=str)
+    parser.add_argument("--num_cameras", default=16, type=int)
+    parser.add_argument("--width", default=320, type=int)
+    parser.add_argument("--height", default=240, type=int)
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--blend_mode", default="scores_softmax", choices=["alpha", "scores", "scores_softmax"])
+    parser.add_argument("--score_mode", default="density", choices=["density", "distance"])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    precision_parser = subparsers.add_parser("precision", help="Texture storage precision against float32")
+    precision_parser.add_argument("--precision", nargs="+", default=["float16", "bfloat16"], choices=["float16", "bfloat16"])
+    precision_parser.add_argument("--min_psnr", default=45.0, type=float)
+    precision_parser.set_defaults(func=benchmark_precision)
+
+    compile_parser = subparsers.add_parser("compile", help="Eager against torch.compile'd kernels")
+    compile_parser.add_argument("--repeats", default=10, type=int)
+    compile_parser.set_defaults(func=benchmark_compile)
+
+    blend_parser = subparsers.add_parser("blend", help="Registered blend modes, stacked and streamed")
+    blend_parser.add_argument("--repeats", default=10, type=int)
+    blend_parser.set_defaults(func=benchmark_blend)
+
+    batched_parser = subparsers.add_parser("batched", help="Batched texture sampling against the per-camera textured_render loop")
+    batched_parser.add_argument("--repeats", default=1, type=int)
+    batched_parser.add_argument("--tolerance", default=1e-4, type=float)
+    batched_parser.set_defaults(func=benchmark_batched)
+
+    rasterizer_parser = subparsers.add_parser("rasterizer", help="PyTorch rasterizer throughput, against the CUDA one on GPUs")
+    pipeline = PipelineParams(rasterizer_parser)
+    rasterizer_parser.add_argument("--num_gaussians", nargs="+", default=[100_000, 300_000, 1_000_000], type=int)
+    rasterizer_parser.add_argument("--repeats", default=3, type=int)
+    rasterizer_parser.set_defaults(func=benchmark_rasterizer)
+
+    args = parser.parse_args()
+    if args.benchmark == "rasterizer":
+        args.pipe = pipeline.extract(args)
+    torch.manual_seed(0)
+    args.func(args)
@@ -0,0 +1,190 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import torch
+from utils.general_utils import kernel
+
+# Blend modes by name, see register_blend_mode
+BLEND_MODES = {}
+
+def register_blend_mode(name):
+    def register(cls):
+        cls.name = name
+        BLEND_MODES[name] = cls
+        return cls
+    return register
+
+def get_blend_mode(name):
+    if name not in BLEND_MODES:
+        raise ValueError("Unknown blend mode "+name)
+    return BLEND_MODES[name]
+
+def parse_blend_mode(blend_mode):
+    """
+    Splits a blend mode as given on the command line into a registered blend mode and a score
+    mode. A trailing "2" selects "distance" scores, e.g. "scores_softmax2".
+    """
+    score_mode = "density"
+    if blend_mode not in BLEND_MODES and blend_mode.endswith("2"):
+        score_mode = "distance"
+        blend_mode = blend_mode[:-1]
+    get_blend_mode(blend_mode)
+    return blend_mode, score_mode
+
+class BlendMode:
+    """
+    Base of the blend modes. A blend mode keeps running per-pixel state: update folds in batches
+    of colours (K,3,N), masks (K,1,N) and scores (K,1,N) in the order the cameras were sampled,
+    and result returns the blended colours (3,N) and mask (1,N). Feeding the cameras in one batch
+    or in several gives the same result. State is float32, whatever the dtype of the inputs.
+    """
+    def __init__(self, num_pixels, device):
+        self.num_pixels = num_pixels
+        self.device = device
+
+    def zeros(self, channels):
+        return torch.zeros((channels,self.num_pixels),dtype=torch.float32,device=self.device)
+
+    def update(self, colors, masks, scores):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+    def weights(self, masks, scores):
+        """
+        Weights (K,1,N) of the cameras of a complete stack in the blended colours.
+        """
+        raise NotImplementedError
+
+def blend_stack(blend_mode, colors, masks, scores, **kwargs):
+    """
+    Blends complete stacks of K cameras in one call.
+    """
+    mode = get_blend_mode(blend_mode)(colors.shape[-1], colors.device, **kwargs)
+    mode.update(colors, masks, scores)
+    return mode.result()
+
+def blend_weights(blend_mode, masks, scores, **kwargs):
+    """
+    Weights of complete stacks of K cameras in the colours blend_stack would return.
+    """
+    return get_blend_mode(blend_mode)(masks.shape[-1], masks.device, **kwargs).weights(masks, scores)
+
+def blend_alpha_step(color, transmittance, colors, masks):
+    # Exclusive cumulative product: the transmittance in front of every camera of the batch
+    visible = torch.cumprod(1-masks,dim=0)
+    before = torch.cat([torch.ones_like(visible[:1]),visible[:-1]])
+    w = masks * before * transmittance
+    return color + (colors*w).sum(dim=0), transmittance * visible[-1]
+
+def blend_softmax_step(color, weight, max_score, colors, scores, temperature):
+    # Online softmax, rescaled to the running maximum like logsumexp
+    new_max_score = torch.maximum(max_score, scores.amax(dim=0)).detach()
+    rescale = torch.exp((max_score-new_max_score)*temperature)
+    w = torch.exp((scores-new_max_score)*temperature)
+    return color*rescale + (colors*w).sum(dim=0), weight*rescale + w.sum(dim=0), new_max_score
+
+def blend_argmax_step(color, weight, max_score, colors, scores):
+    new_max_score = torch.maximum(max_score, scores.amax(dim=0))
+    keep = (max_score==new_max_score).float()
+    w = (scores==new_max_score).float()
+    return color*keep + (colors*w).sum(dim=0), weight*keep + w.sum(dim=0), new_max_score
+
+@register_blend_mode("alpha")
+class AlphaBlend(BlendMode):
+    """
+    Front to back compositing of the cameras with their masks as opacity.
+    """
+    def __init__(self, num_pixels, device):
+        super().__init__(num_pixels, device)
+        self.color = self.zeros(3)
+        self.transmittance = self.zeros(1)+1
+
+    def update(self, colors, masks, scores):
+        self.color, self.transmittance = kernel(blend_alpha_step)(self.color, self.transmittance, colors, masks)
+
+    def result(self):
+        return self.color, 1 - self.transmittance
+
+    def weights(self, masks, scores):
+        visible = torch.cumprod(1-masks,dim=0)
+        return masks * torch.cat([torch.ones_like(visible[:1]),visible[:-1]])
+
+class ScoreBlend(BlendMode):
+    """
+    Normalised blend of the cameras weighted by a function of their scores.
+    """
+    def __init__(self, num_pixels, device):
+        super().__init__(num_pixels, device)
+        self.color = self.zeros(3)
+        self.weight = self.zeros(1)
+        self.max_score = self.zeros(1)-float("inf")
+        self.mask_sum = self.zeros(1)
+
+    def update(self, colors, masks, scores):
+        self.mask_sum = self.mask_sum + masks.sum(dim=0)
+
+    def result(self):
+        eps = 1e-10
+        render_textured = self.color / (self.weight+eps)
+        render_textured_mask = torch.minimum(self.mask_sum,torch.ones_like(self.mask_sum))
+        return render_textured, render_textured_mask
+
+@register_blend_mode("scores_softmax")
+class SoftmaxBlend(ScoreBlend):
+    def __init__(self, num_pixels, device, temperature=4):
+        super().__init__(num_pixels, device)
+        self.temperature = temperature
+
+    def update(self, colors, masks, scores):
+        super().update(colors, masks, scores)
+        self.color, self.weight, self.max_score = kernel(blend_softmax_step)(self.color, self.weight, self.max_score, colors, scores, self.temperature)
+
+    def weights(self, masks, scores):
+        return torch.softmax(scores*self.temperature, dim=0)
+
+@register_blend_mode("scores")
+class ArgmaxBlend(ScoreBlend):
+    """
+    Colour of the best scoring camera, averaged over ties.
+    """
+    def update(self, colors, masks, scores):
+        super().update(colors, masks, scores)
+        self.color, self.weight, self.max_score = kernel(blend_argmax_step)(self.color, self.weight, self.max_score, colors, scores)
+
+    def weights(self, masks, scores):
+        w = (scores==scores.amax(dim=0)).float()
+        return w / w.sum(dim=0)
+
+class StreamingBlend:
+    """
+    Blends texture cameras into a render as they are sampled, with a registered blend mode,
+    and tracks which pixels are in frame of any camera.
+
+    Colours, masks, in-frame masks and scores are passed to update in batches of shape (K,C,N).
+    """
+    def __init__(self, blend_mode, num_pixels, device, track_in_frame=True, **kwargs):
+        self.blend_mode = blend_mode
+        self.mode = get_blend_mode(blend_mode)(num_pixels, device, **kwargs)
+        self.track_in_frame = track_in_frame
+        self.not_in_frame = torch.ones((1,num_pixels),dtype=torch.float32,device=device)
+
+    def update(self, colors, masks, in_frame, scores):
+        if self.track_in_frame:
+            self.not_in_frame = self.not_in_frame * torch.prod(1-in_frame,dim=0)
+        self.mode.update(colors, masks, scores)
+
+    def result(self):
+        return self.mode.result()
+
+    def in_frame(self):
+        return 1 - self.not_in_frame
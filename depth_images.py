@@ -1,6 +1,7 @@
 from utils.graphics_utils import geom_transform_points, fov2focal
 import torch
 import numpy as np
+from collections import OrderedDict
 from utils.graphics_utils import fov2focal
 
 
@@ -45,35 +46,91 @@ def calibrate_depth(scene):
         if test_camera.depth!=None:
             test_camera.depth[test_camera.depth!=0] = test_camera.depth[test_camera.depth!=0]*alpha+beta
 
-def depth_image_to_point_cloud(depth, camera):
-    mat = camera.world_view_transform.T
-
-    fx = fov2focal(camera.FoVx,camera.image_width)
-    fy = fov2focal(camera.FoVy,camera.image_height)
-    cx = camera.image_width/2
-    cy = camera.image_height/2
-
-    _,h,w = depth.shape
-
-    device = depth.device
-    pixel_coords = torch.zeros((h,w,2),device = device).float()
-
-    pixel_coords[:,:,1], pixel_coords[:,:,0]  = torch.meshgrid(torch.arange(0,h,device=device),torch.arange(0,w,device=device),indexing="ij")
-    
-    flat_cam_coords = torch.zeros((h,w,3),device=device).float()
-    flat_cam_coords[:,:,0] = (pixel_coords[:,:,0] - cx)/fx
-    flat_cam_coords[:,:,1]  = (pixel_coords[:,:,1] - cy)/fy
-    flat_cam_coords[:,:,2]  = 1
-
-    #flat_origin_dist = flat_cam_coords.norm(dim=2).unsqueeze(0)
-    point_cam_coords = flat_cam_coords.unsqueeze(0) * (depth).unsqueeze(3)
-    
-    if mat is None:
-        return point_cam_coords.reshape((-1,3))
-    else:
-        return geom_transform_points(point_cam_coords.reshape((-1,3)), torch.linalg.inv(mat).T)
-
-
+# Unit depth camera space rays, most recently used last
+camera_rays_cache = OrderedDict()
+MAX_CACHED_RAYS = 16
+camera_rays_capacity = MAX_CACHED_RAYS
+
+def reserve_camera_rays(num_windows):
+    """
+    Grows the ray cache so that num_windows windows, e.g. all tiles of a frame, fit in it next to
+    MAX_CACHED_RAYS other entries, and are not evicted by each other from one frame to the next.
+    """
+    global camera_rays_capacity
+    camera_rays_capacity = max(camera_rays_capacity, MAX_CACHED_RAYS + num_windows)
+
+def camera_rays(camera, shape, pixel_offset=(0,0), image_size=None, device="cuda"):
+    """
+    Camera space directions with unit depth through the pixels of a (h,w) window at pixel_offset
+    of an image of image_size (h,w), as a (h*w,3) tensor. Cached per intrinsics and window.
+    If the image is smaller than the camera's, a pixel stands for a block of camera pixels and
+    its ray goes through the center of that block.
+    """
+    h, w = shape
+    image_h, image_w = (h,w) if image_size is None else image_size
+    x0, y0 = pixel_offset
+
+    key = (camera.FoVx, camera.FoVy, camera.image_width, camera.image_height, image_w, image_h, x0, y0, w, h, str(device))
+    rays = camera_rays_cache.get(key)
+    if rays is not None:
+        camera_rays_cache.move_to_end(key)
+        return rays
+
+    fx = fov2focal(camera.FoVx,image_w)
+    fy = fov2focal(camera.FoVy,image_h)
+    cx = image_w/2
+    cy = image_h/2
+
+    # 0.5*(factor-1) camera pixels, in pixels of the downsampled image
+    offset_x = 0.5*(1 - image_w/camera.image_width)
+    offset_y = 0.5*(1 - image_h/camera.image_height)
+
+    y, x = torch.meshgrid(torch.arange(y0,y0+h,device=device).float()+offset_y,torch.arange(x0,x0+w,device=device).float()+offset_x,indexing="ij")
+    rays = torch.stack([(x - cx)/fx, (y - cy)/fy, torch.ones_like(x)],dim=2).reshape((-1,3))
+
+    camera_rays_cache[key] = rays
+    if len(camera_rays_cache) > camera_rays_capacity:
+        camera_rays_cache.popitem(last=False)
+    return rays
+
+def view_world_transform(camera):
+    """
+    Inverse of camera.world_view_transform, cached on the camera until the transform is replaced.
+    """
+    cached = getattr(camera, "view_world_cache", None)
+    if cached is None or cached[0] is not camera.world_view_transform:
+        cached = (camera.world_view_transform, torch.linalg.inv(camera.world_view_transform))
+        camera.view_world_cache = cached
+    return cached[1]
+
+def depth_image_to_point_cloud(depth, camera, pixel_offset=(0,0), image_size=None):
+    """
+    Back-projects depth to world space. depth may be a tile of an image of image_size (h,w)
+    whose top left pixel is at pixel_offset (x,y). By default the intrinsics follow the depth
+    resolution, so that downsampled depth images can be back-projected.
+    """
+    rays = camera_rays(camera, depth.shape[1:], pixel_offset, image_size, depth.device)
+    transform = view_world_transform(camera).to(depth)
+    return torch.addmm(transform[3,:3], rays*depth.reshape((-1,1)), transform[:3,:3])
+
+def depth_images_to_point_clouds(depths, cameras):
+    """
+    Batched depth_image_to_point_cloud, with one baddbmm per group of cameras that share
+    intrinsics and resolution. Returns the (h*w,3) point clouds in the order of cameras.
+    """
+    groups = {}
+    for i, (depth, camera) in enumerate(zip(depths, cameras)):
+        groups.setdefault((camera.FoVx, camera.FoVy, camera.image_width, camera.image_height, *depth.shape), []).append(i)
+
+    points = [None]*len(cameras)
+    for indices in groups.values():
+        depth = torch.stack([depths[i] for i in indices])
+        rays = camera_rays(cameras[indices[0]], depth.shape[2:], device=depth.device)
+        transforms = torch.stack([view_world_transform(cameras[i]) for i in indices]).to(depth)
+        group_points = torch.baddbmm(transforms[:,3:,:3], rays.unsqueeze(0)*depth.reshape((len(indices),-1,1)), transforms[:,:3,:3])
+        for i, camera_points in zip(indices, group_points):
+            points[i] = camera_points
+    return points
 
 def camera_to_pcd(camera):
     depth = camera.depth.cuda()
@@ -82,6 +139,18 @@ def camera_to_pcd(camera):
 
     return points, colors
 
+def cameras_to_pcd(cameras, batch_size=16):
+    """
+    camera_to_pcd over all cameras, back-projecting batch_size depth images at a time.
+    """
+    all_points = []
+    all_colors = []
+    for i in range(0,len(cameras),batch_size):
+        batch = cameras[i:i+batch_size]
+        all_points += depth_images_to_point_clouds([camera.depth.cuda() for camera in batch], batch)
+        all_colors += [camera.original_image.permute((1,2,0)).reshape((-1,3)).float() for camera in batch]
+    return all_points, all_colors
+
 def camera_frustrum_points(camera):
     mat = camera.world_view_transform.T
 
@@ -110,7 +179,7 @@ def camera_frustrum_points(camera):
     if mat is None:
         return point_cam_coords.reshape((-1,3))
     else:
-        return geom_transform_points(point_cam_coords.reshape((-1,3)), torch.linalg.inv(mat).T)
+        return geom_transform_points(point_cam_coords.reshape((-1,3)), view_world_transform(camera))
     
 def depth_smoothness_loss(depth_image, image,alpha=20):
     dx_depth = depth_image[:,1:,:]-depth_image[:,:-1,:]
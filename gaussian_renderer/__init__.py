@@ -11,29 +11,154 @@
 
 import torch
 import math
-from diff_gaussian_rasterization import GaussianRasterizationSettings, GaussianRasterizer
+try:
+    from diff_gaussian_rasterization import GaussianRasterizationSettings, GaussianRasterizer
+
+    CUDA_RASTERIZER_FOUND = True
+except ImportError:
+    from gaussian_renderer.torch_rasterizer import GaussianRasterizationSettings
+
+    CUDA_RASTERIZER_FOUND = False
+from gaussian_renderer.torch_rasterizer import TorchGaussianRasterizer
 from scene.gaussian_model import GaussianModel
 from utils.sh_utils import eval_sh
 from utils.graphics_utils import fov2focal, geom_transform_points
 
-def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor, scaling_modifier = 1.0, override_color = None, render_depth=True, depth_exp=1.0, texture_camera=None, normalize_depth=True):
+class RenderPackage(dict):
+    """
+    Dictionary of render outputs whose expensive fields are only computed on first access.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_fields = {}
+
+    def add_lazy(self, key, compute):
+        self.lazy_fields[key] = compute
+
+    def __missing__(self, key):
+        if key not in self.lazy_fields:
+            raise KeyError(key)
+        value = self.lazy_fields.pop(key)()
+        self[key] = value
+        return value
+
+    def __contains__(self, key):
+        return super().__contains__(key) or key in self.lazy_fields
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def copy(self):
+        # dict.copy and {**pkg} would drop the fields that were not computed yet
+        render_pkg = RenderPackage(super().items())
+        render_pkg.lazy_fields.update(self.lazy_fields)
+        return render_pkg
+
+def proj_params(cameras, device="cuda"):
+    """
+    Pinhole intrinsics fx, fy, cx, cy of cameras, as a (C,4) tensor on device.
+    """
+    return torch.tensor([[
+        fov2focal(camera.FoVx,camera.image_width),
+        fov2focal(camera.FoVy,camera.image_height),
+        camera.image_width/2,
+        camera.image_height/2
+    ] for camera in cameras], device=device)
+
+def make_rasterizer(raster_settings, pipe):
+    """
+    The rasterizer selected by pipe.rasterizer: the CUDA extension, or the PyTorch one that
+    also runs on the cpu.
+    """
+    if pipe.rasterizer == "torch":
+        return TorchGaussianRasterizer(raster_settings=raster_settings)
+    if pipe.rasterizer != "cuda":
+        raise ValueError(f"Unknown rasterizer {pipe.rasterizer}, expected cuda or torch")
+    if not CUDA_RASTERIZER_FOUND:
+        raise ImportError("diff_gaussian_rasterization is not installed, use --rasterizer torch")
+    return GaussianRasterizer(raster_settings=raster_settings)
+
+def make_raster_settings(viewpoint_camera, pc, pipe, bg_color, scaling_modifier=1.0, proj_param=None):
+    if proj_param is None:
+        proj_param = proj_params([viewpoint_camera], pc.get_xyz.device)[0]
+    return GaussianRasterizationSettings(
+        image_height=int(viewpoint_camera.image_height),
+        image_width=int(viewpoint_camera.image_width),
+        tanfovx=math.tan(viewpoint_camera.FoVx * 0.5),
+        tanfovy=math.tan(viewpoint_camera.FoVy * 0.5),
+        bg=bg_color,
+        scale_modifier=scaling_modifier,
+        viewmatrix=viewpoint_camera.world_view_transform,
+        projmatrix=viewpoint_camera.full_proj_transform,
+        proj_param=proj_param,
+        sh_degree=pc.active_sh_degree,
+        campos=viewpoint_camera.camera_center,
+        prefiltered=False,
+        debug=pipe.debug
+    )
+
+def frustum_cull(viewpoint_camera, pc : GaussianModel, scaling_modifier = 1.0, near = 0.2):
+    """
+    Conservative mask of the Gaussians the rasterizer may give a non-zero radius. It follows
+    preprocessCUDA: the center must be beyond the near plane, and the screen rectangle of the
+    radius must touch a tile. The radius is bounded from above with the largest scale of each
+    Gaussian: for the EWA Jacobian J, with the view ray clamped to 1.3 tan_fov, the largest
+    eigenvalue of J J^T is (f/z)^2 (1+a^2+b^2), a and b being the clamped ray slopes. On top come
+    the 0.3 pixel low-pass and the 0.1 floor of the eigenvalue computation. Pure torch, so it
+    also runs on the cpu.
+    """
+    W, H = viewpoint_camera.image_width, viewpoint_camera.image_height
+    tan_fovx = math.tan(viewpoint_camera.FoVx * 0.5)
+    tan_fovy = math.tan(viewpoint_camera.FoVy * 0.5)
+    focal = max(W / (2 * tan_fovx), H / (2 * tan_fovy))
+
+    xyz = pc.get_xyz.detach()
+    p_view = xyz @ viewpoint_camera.world_view_transform[:3,:3] + viewpoint_camera.world_view_transform[3,:3]
+    p_hom = xyz @ viewpoint_camera.full_proj_transform[:3] + viewpoint_camera.full_proj_transform[3]
+    p_proj = p_hom[:,:2] / (p_hom[:,3:] + 0.0000001)
+    size = torch.tensor([W, H], dtype=xyz.dtype, device=xyz.device)
+    points_xy = ((p_proj + 1) * size - 1) * 0.5
+
+    z = torch.clamp(p_view[:,2], min=near)
+    a = torch.clamp(p_view[:,0] / z, -1.3*tan_fovx, 1.3*tan_fovx)
+    b = torch.clamp(p_view[:,1] / z, -1.3*tan_fovy, 1.3*tan_fovy)
+    sigma = focal * scaling_modifier * pc.get_scaling.detach().amax(dim=1) / z
+    # One more pixel for rounding differences with the rasterizer
+    radius = torch.ceil(3 * torch.sqrt(sigma**2 * (1 + a**2 + b**2) + 0.3 + math.sqrt(0.1))) + 1
+
+    # The tile grid covers whole tiles, which may reach beyond the image
+    grid_size = torch.tensor([-(-W // 16) * 16, -(-H // 16) * 16], dtype=xyz.dtype, device=xyz.device)
+    visible = p_view[:,2] > near
+    visible &= ((points_xy + radius.unsqueeze(1) >= 0) & (points_xy - radius.unsqueeze(1) < grid_size)).all(dim=1)
+    return visible
+
+def scatter_radii(radii, visible, num_points):
+    """
+    Radii of the culled subset visible scattered back to all num_points Gaussians, 0 for the culled ones.
+    """
+    if visible is None:
+        return radii
+    full_radii = torch.zeros(num_points, dtype=radii.dtype, device=radii.device)
+    full_radii[visible] = radii
+    return full_radii
+
+def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor, scaling_modifier = 1.0, override_color = None, render_depth=True, depth_exp=1.0, texture_camera=None, normalize_depth=True, outputs=None):
     """
     Render the scene. 
     
     Background tensor (bg_color) must be on GPU!
+
+    If outputs is given, only the listed fields of the returned package are guaranteed.
     """
  
     # Create zero tensor. We will use it to make pytorch return gradients of the 2D (screen-space) means
-    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device="cuda") + 0
+    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True) + 0
     try:
         screenspace_points.retain_grad()
     except:
         pass
 
     # Set up rasterization configuration
-    tanfovx = math.tan(viewpoint_camera.FoVx * 0.5)
-    tanfovy = math.tan(viewpoint_camera.FoVy * 0.5)
-
     if render_depth:
         bg_color = torch.cat([
             bg_color,
@@ -41,31 +166,12 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
             torch.tensor([0.0],device=bg_color.device)
         ])
 
-    fx = fov2focal(viewpoint_camera.FoVx,viewpoint_camera.image_width)
-    fy = fov2focal(viewpoint_camera.FoVy,viewpoint_camera.image_height)
-    cx = viewpoint_camera.image_width/2
-    cy = viewpoint_camera.image_height/2
-    raster_settings = GaussianRasterizationSettings(
-        image_height=int(viewpoint_camera.image_height),
-        image_width=int(viewpoint_camera.image_width),
-        tanfovx=tanfovx,
-        tanfovy=tanfovy,
-        bg=bg_color,
-        scale_modifier=scaling_modifier,
-        viewmatrix=viewpoint_camera.world_view_transform,
-        projmatrix=viewpoint_camera.full_proj_transform,
-        proj_param=torch.tensor([fx,fy,cx,cy]).cuda(),
-        sh_degree=pc.active_sh_degree,
-        campos=viewpoint_camera.camera_center,
-        prefiltered=False,
-        debug=pipe.debug
-    )
-
-    rasterizer = GaussianRasterizer(raster_settings=raster_settings)
+    rasterizer = make_rasterizer(make_raster_settings(viewpoint_camera, pc, pipe, bg_color, scaling_modifier), pipe)
 
     means3D = pc.get_xyz
     means2D = screenspace_points
     opacity = pc.get_opacity
+    features = pc.get_features
 
     # If precomputed 3d covariance is provided, use it. If not, then it will be computed from
     # scaling / rotation by the rasterizer.
@@ -78,6 +184,19 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
         scales = pc.get_scaling
         rotations = pc.get_rotation
 
+    # Only the Gaussians that may overlap the view go through SH evaluation and rasterization,
+    # gradients reach the full size tensors through the indexing
+    visible = None
+    if pipe.frustum_culling:
+        visible = torch.nonzero(frustum_cull(viewpoint_camera, pc, scaling_modifier))[:,0]
+        means3D, means2D, opacity, features = means3D[visible], means2D[visible], opacity[visible], features[visible]
+        if cov3D_precomp is not None:
+            cov3D_precomp = cov3D_precomp[visible]
+        else:
+            scales, rotations = scales[visible], rotations[visible]
+        if override_color is not None:
+            override_color = override_color[visible]
+
     # If precomputed colors are provided, use them. Otherwise, if it is desired to precompute colors
     # from SHs in Python, do it. If not, then SH -> RGB conversion will be done by rasterizer.
     shs = None
@@ -85,8 +204,8 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
     if pipe.convert_SHs_python:
         
         if override_color is None:
-            shs_view = pc.get_features.transpose(1, 2).view(-1, 3, (pc.max_sh_degree+1)**2)
-            dir_pp = (pc.get_xyz - viewpoint_camera.camera_center.repeat(pc.get_features.shape[0], 1))
+            shs_view = features.transpose(1, 2).view(-1, 3, (pc.max_sh_degree+1)**2)
+            dir_pp = (means3D - viewpoint_camera.camera_center.repeat(features.shape[0], 1))
             dir_pp_normalized = dir_pp/dir_pp.norm(dim=1, keepdim=True)
             sh2rgb = eval_sh(pc.active_sh_degree, shs_view, dir_pp_normalized)
             colors_precomp = torch.clamp_min(sh2rgb + 0.5, 0.0)
@@ -97,23 +216,26 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
             # pc.get_xyz.retain_grad()
             # pc.get_xyz.requires_grad_(True)
             
-            trans_points = geom_transform_points(pc.get_xyz, viewpoint_camera.world_view_transform)
+            if outputs is None or "render_depth" in outputs:
+                trans_points = geom_transform_points(means3D, viewpoint_camera.world_view_transform)
 
-            zval = trans_points[:,2]
-            #depth = torch.norm(pc.get_xyz-viewpoint_camera.camera_center,dim=1)
-            depth = zval**depth_exp
+                zval = trans_points[:,2]
+                #depth = torch.norm(pc.get_xyz-viewpoint_camera.camera_center,dim=1)
+                depth = zval**depth_exp
+            else:
+                # The rasterizer always blends all channels, the depth channel is just left empty
+                depth = torch.zeros_like(colors_precomp[:,0])
             #depth.retain_grad()
             #depth.requires_grad_(True)
-            colors_precomp = torch.concat([colors_precomp,depth.reshape((-1,1))],dim=1)
-            colors_precomp = torch.concat([colors_precomp,torch.ones_like(depth).reshape((-1,1))],dim=1)
+            colors_precomp = torch.cat([colors_precomp,depth.reshape((-1,1)),torch.ones_like(depth).reshape((-1,1))],dim=1)
     else:
-        shs = pc.get_features
+        shs = features
 
     # Rasterize visible Gaussians to image, obtain their radii (on screen). 
     if texture_camera is not None:
         texture = torch.cat([
             texture_camera.original_image,
-            texture_camera.rendered_depth
+            texture_camera.rendered_depth.float()
         ])
         rendered_image, radii = rasterizer(
             means3D = means3D,
@@ -126,6 +248,7 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
             cov3D_precomp = cov3D_precomp,
             texture=texture,
             texture_proj_mat=texture_camera.full_proj_transform)
+        radii = scatter_radii(radii, visible, screenspace_points.shape[0])
         
         render_texture = rendered_image[:3]
         render_mask = rendered_image[3:4]#*torch.exp(pc.depth_scale)
@@ -151,24 +274,199 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
             scales = scales,
             rotations = rotations,
             cov3D_precomp = cov3D_precomp)
+        radii = scatter_radii(radii, visible, screenspace_points.shape[0])
 
         render_rgb = rendered_image[:3]
-        render_depth = rendered_image[3:4]#*torch.exp(pc.depth_scale)
         render_opacity = rendered_image[4:]#*torch.exp(pc.depth_scale)
 
-        if normalize_depth:
-            render_depth = render_depth/torch.clamp(render_opacity,0.05,10000)
+        def compute_render_depth():
+            render_depth = rendered_image[3:4]#*torch.exp(pc.depth_scale)
+            if normalize_depth:
+                render_depth = render_depth/torch.clamp(render_opacity,0.05,10000)
         
-        render_depth = render_depth**(1/depth_exp)
+            return render_depth**(1/depth_exp)
 
         # render_depth.retain_grad()
         # render_depth.requires_grad_(True)
 
         # Those Gaussians that were frustum culled or had a radius of 0 were not visible.
         # They will be excluded from value updates used in the splitting criteria.
-        return {"render": render_rgb,
-                "render_depth": render_depth,
+        render_pkg = RenderPackage({"render": render_rgb,
                 "render_opacity": render_opacity,
                 "viewspace_points": screenspace_points,
                 "visibility_filter" : radii > 0,
-                "radii": radii}
+                "radii": radii})
+        if outputs is None or "render_depth" in outputs:
+            render_pkg.add_lazy("render_depth", compute_render_depth)
+        return render_pkg
+
+def render_depths(cameras, pc : GaussianModel, pipe, scaling_modifier = 1.0, normalize_depth=True):
+    """
+    Depth and opacity of the scene seen from each of cameras, for shadow maps. Yields one
+    dictionary per camera with render_depth, render_opacity, visibility_filter and radii.
+
+    Spherical harmonics are not evaluated and the colour channels are left empty. Everything
+    that does not depend on the camera is prepared once for all cameras.
+    """
+    means3D = pc.get_xyz
+    opacity = pc.get_opacity
+    scales = None
+    rotations = None
+    cov3D_precomp = None
+    if pipe.compute_cov3D_python:
+        cov3D_precomp = pc.get_covariance(scaling_modifier)
+    else:
+        scales = pc.get_scaling
+        rotations = pc.get_rotation
+
+    # The rasterizer blends RGB, depth and opacity, only depth changes from one camera to the next
+    colors = torch.zeros((means3D.shape[0], 3), device=means3D.device)
+    ones = torch.ones((means3D.shape[0], 1), device=means3D.device)
+    bg = torch.zeros(5, device=means3D.device)
+    cameras = list(cameras)
+    params = proj_params(cameras, means3D.device) if len(cameras) > 0 else None
+
+    for i, camera in enumerate(cameras):
+        rasterizer = make_rasterizer(make_raster_settings(camera, pc, pipe, bg, scaling_modifier, params[i]), pipe)
+
+        depth = means3D @ camera.world_view_transform[:3,2:3] + camera.world_view_transform[3,2]
+        rendered_image, radii = rasterizer(
+            means3D = means3D,
+            means2D = torch.zeros_like(means3D),
+            shs = None,
+            colors_precomp = torch.cat([colors, depth, ones], dim=1),
+            opacities = opacity,
+            scales = scales,
+            rotations = rotations,
+            cov3D_precomp = cov3D_precomp)
+
+        render_opacity = rendered_image[4:]
+        render_depth = rendered_image[3:4]
+        if normalize_depth:
+            render_depth = render_depth/torch.clamp(render_opacity,0.05,10000)
+
+        yield {"render_depth": render_depth,
+               "render_opacity": render_opacity,
+               "visibility_filter" : radii > 0,
+               "radii": radii}
+
+def render_batch(cameras, pc : GaussianModel, pipe, bg_color : torch.Tensor, scaling_modifier = 1.0, override_color = None, depth_exp=1.0, normalize_depth=True, outputs=None, batch_size=16, max_elements=2**24):
+    """
+    Renders each of cameras as render() with render_depth=True does, yielding one RenderPackage
+    per camera in order.
+
+    Activations, SH coefficients and the background are prepared once. Intrinsics are built in
+    one tensor for all cameras. View depths and SH colours are evaluated for batch_size cameras
+    at a time, over the flat list of their (camera, Gaussian) pairs in chunks of about
+    max_elements SH coefficients, so memory does not grow with batch_size. With
+    pipe.frustum_culling each camera only gets the Gaussians frustum_cull keeps.
+    Rasterization itself is unchanged, one call per camera.
+    """
+    cameras = list(cameras)
+    if not pipe.convert_SHs_python:
+        # The rasterizer evaluates the SH itself, there is nothing to share
+        for camera in cameras:
+            yield render(camera, pc, pipe, bg_color, scaling_modifier, override_color, depth_exp=depth_exp, normalize_depth=normalize_depth, outputs=outputs)
+        return
+    if len(cameras) == 0:
+        return
+
+    means3D = pc.get_xyz
+    opacity = pc.get_opacity
+    scales = None
+    rotations = None
+    cov3D_precomp = None
+    if pipe.compute_cov3D_python:
+        cov3D_precomp = pc.get_covariance(scaling_modifier)
+    else:
+        scales = pc.get_scaling
+        rotations = pc.get_rotation
+
+    num_points = means3D.shape[0]
+    device = means3D.device
+    bg = torch.cat([bg_color, torch.zeros(2, device=bg_color.device)])
+    ones = torch.ones((num_points, 1), device=device)
+    all_points = torch.arange(num_points, device=device)
+    if override_color is None:
+        shs_view = pc.get_features.transpose(1, 2).view(-1, 3, (pc.max_sh_degree+1)**2)
+    chunk_size = max(1, max_elements // (3*(pc.max_sh_degree+1)**2))
+    params = proj_params(cameras, device)
+    wants_depth = outputs is None or "render_depth" in outputs
+
+    for start in range(0, len(cameras), batch_size):
+        batch = cameras[start:start+batch_size]
+        view_matrices = torch.stack([camera.world_view_transform for camera in batch])
+        camera_centers = torch.stack([camera.camera_center for camera in batch])
+
+        visible = [None] * len(batch)
+        if pipe.frustum_culling:
+            visible = [torch.nonzero(frustum_cull(camera, pc, scaling_modifier))[:,0] for camera in batch]
+        counts = [num_points if v is None else v.shape[0] for v in visible]
+        gaussian_ids = torch.cat([all_points if v is None else v for v in visible])
+        camera_ids = torch.repeat_interleave(torch.arange(len(batch), device=device), torch.tensor(counts, device=device))
+
+        # View depths and colours of the (camera, Gaussian) pairs of the batch, at least one
+        # chunk is evaluated so that the concatenations below are never empty
+        colors = []
+        depths = []
+        for chunk_start in range(0, max(len(gaussian_ids), 1), chunk_size):
+            ids = gaussian_ids[chunk_start:chunk_start+chunk_size]
+            cams = camera_ids[chunk_start:chunk_start+chunk_size]
+            points = means3D[ids]
+            if wants_depth:
+                depths.append(((points*view_matrices[cams,:3,2]).sum(dim=1) + view_matrices[cams,3,2])**depth_exp)
+            if override_color is None:
+                dir_pp = points - camera_centers[cams]
+                dir_pp_normalized = dir_pp/dir_pp.norm(dim=1, keepdim=True)
+                colors.append(torch.clamp_min(eval_sh(pc.active_sh_degree, shs_view[ids], dir_pp_normalized) + 0.5, 0.0))
+            else:
+                colors.append(override_color[ids])
+        colors = torch.cat(colors).split(counts)
+        if wants_depth:
+            depths = torch.cat(depths).split(counts)
+
+        for i, camera in enumerate(batch):
+            screenspace_points = torch.zeros_like(means3D, requires_grad=True) + 0
+            try:
+                screenspace_points.retain_grad()
+            except:
+                pass
+
+            camera_means3D, means2D, camera_opacity = means3D, screenspace_points, opacity
+            camera_scales, camera_rotations, camera_cov3D = scales, rotations, cov3D_precomp
+            if visible[i] is not None:
+                camera_means3D, means2D, camera_opacity = means3D[visible[i]], screenspace_points[visible[i]], opacity[visible[i]]
+                if cov3D_precomp is not None:
+                    camera_cov3D = cov3D_precomp[visible[i]]
+                else:
+                    camera_scales, camera_rotations = scales[visible[i]], rotations[visible[i]]
+            camera_depth = depths[i].unsqueeze(1) if wants_depth else torch.zeros_like(ones[:counts[i]])
+
+            rasterizer = make_rasterizer(make_raster_settings(camera, pc, pipe, bg, scaling_modifier, params[start+i]), pipe)
+            rendered_image, radii = rasterizer(
+                means3D = camera_means3D,
+                means2D = means2D,
+                shs = None,
+                colors_precomp = torch.cat([colors[i], camera_depth, ones[:counts[i]]], dim=1),
+                opacities = camera_opacity,
+                scales = camera_scales,
+                rotations = camera_rotations,
+                cov3D_precomp = camera_cov3D)
+            radii = scatter_radii(radii, visible[i], num_points)
+
+            render_opacity = rendered_image[4:]
+
+            def compute_render_depth(rendered_image=rendered_image, render_opacity=render_opacity):
+                render_depth = rendered_image[3:4]
+                if normalize_depth:
+                    render_depth = render_depth/torch.clamp(render_opacity,0.05,10000)
+                return render_depth**(1/depth_exp)
+
+            render_pkg = RenderPackage({"render": rendered_image[:3],
+                    "render_opacity": render_opacity,
+                    "viewspace_points": screenspace_points,
+                    "visibility_filter" : radii > 0,
+                    "radii": radii})
+            if wants_depth:
+                render_pkg.add_lazy("render_depth", compute_render_depth)
+            yield render_pkg
@@ -0,0 +1,260 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import torch
+from typing import NamedTuple
+from utils.sh_utils import eval_sh
+
+BLOCK_X = 16
+BLOCK_Y = 16
+
+class GaussianRasterizationSettings(NamedTuple):
+    """
+    Same fields as diff_gaussian_rasterization.GaussianRasterizationSettings, for when the CUDA
+    extension is not installed.
+    """
+    image_height: int
+    image_width: int
+    tanfovx : float
+    tanfovy : float
+    bg : torch.Tensor
+    scale_modifier : float
+    viewmatrix : torch.Tensor
+    projmatrix : torch.Tensor
+    proj_param: torch.Tensor
+    sh_degree : int
+    campos : torch.Tensor
+    prefiltered : bool
+    debug : bool
+
+def build_covariance(scales, rotations, scale_modifier):
+    """
+    World space covariances (N,3,3) from scales and unnormalized quaternions (r,x,y,z).
+    """
+    q = rotations / rotations.norm(dim=1, keepdim=True)
+    r, x, y, z = q[:,0], q[:,1], q[:,2], q[:,3]
+    R = torch.stack([
+        1 - 2 * (y * y + z * z), 2 * (x * y - r * z), 2 * (x * z + r * y),
+        2 * (x * y + r * z), 1 - 2 * (x * x + z * z), 2 * (y * z - r * x),
+        2 * (x * z - r * y), 2 * (y * z + r * x), 1 - 2 * (x * x + y * y)
+    ], dim=1).reshape((-1,3,3))
+    M = R * (scale_modifier * scales).unsqueeze(1)
+    return M @ M.transpose(1,2)
+
+def unpack_covariance(cov3D):
+    # Upper triangle xx, xy, xz, yy, yz, zz, as the CUDA rasterizer stores it
+    xx, xy, xz, yy, yz, zz = cov3D.unbind(dim=1)
+    return torch.stack([xx, xy, xz, xy, yy, yz, xz, yz, zz], dim=1).reshape((-1,3,3))
+
+def preprocess(means3D, means2D, opacities, cov3D, raster_settings):
+    """
+    Projects the Gaussians as preprocessCUDA does. Returns their view depths, pixel centers,
+    conics, radii and screen rectangles in tiles, and the mask of those that reach the image.
+    """
+    W, H = raster_settings.image_width, raster_settings.image_height
+    viewmatrix = raster_settings.viewmatrix.to(means3D)
+    projmatrix = raster_settings.projmatrix.to(means3D)
+    tan_fovx, tan_fovy = raster_settings.tanfovx, raster_settings.tanfovy
+    focal_x = W / (2 * tan_fovx)
+    focal_y = H / (2 * tan_fovy)
+
+    p_view = means3D @ viewmatrix[:3,:3] + viewmatrix[3,:3]
+    p_hom = means3D @ projmatrix[:3] + projmatrix[3]
+    p_proj = p_hom[:,:2] / (p_hom[:,3:] + 0.0000001)
+    # Pixel centers, the gradients of means2D are w.r.t. NDC like those of the CUDA rasterizer
+    scale = torch.tensor([W, H], dtype=means3D.dtype, device=means3D.device)
+    points_xy = ((p_proj + 1) * scale - 1) * 0.5 + means2D[:,:2] * scale * 0.5
+
+    # EWA projection of the covariance, with the view ray clamped to 1.3 times the frustum
+    z = p_view[:,2]
+    safe_z = torch.where(z > 0.2, z, torch.ones_like(z))
+    tx = torch.clamp(p_view[:,0] / safe_z, -1.3*tan_fovx, 1.3*tan_fovx) * safe_z
+    ty = torch.clamp(p_view[:,1] / safe_z, -1.3*tan_fovy, 1.3*tan_fovy) * safe_z
+    zeros = torch.zeros_like(safe_z)
+    J = torch.stack([
+        torch.stack([focal_x / safe_z, zeros, -(focal_x * tx) / (safe_z * safe_z)], dim=1),
+        torch.stack([zeros, focal_y / safe_z, -(focal_y * ty) / (safe_z * safe_z)], dim=1),
+    ], dim=1)
+    T = J @ viewmatrix[:3,:3].T
+    cov2D = T @ cov3D @ T.transpose(1,2)
+    a = cov2D[:,0,0] + 0.3
+    b = cov2D[:,0,1]
+    c = cov2D[:,1,1] + 0.3
+
+    det = a * c - b * b
+    valid = (z > 0.2) & (det != 0)
+    det_inv = 1 / torch.where(valid, det, torch.ones_like(det))
+    conic = torch.stack([c * det_inv, -b * det_inv, a * det_inv], dim=1)
+
+    with torch.no_grad():
+        mid = 0.5 * (a + c)
+        lambda1 = mid + torch.sqrt(torch.clamp(mid * mid - det, min=0.1))
+        lambda2 = mid - torch.sqrt(torch.clamp(mid * mid - det, min=0.1))
+        radii = torch.ceil(3 * torch.sqrt(torch.clamp(torch.maximum(lambda1, lambda2), min=0)))
+        radii = torch.where(valid, radii, torch.zeros_like(radii))
+
+        grid_x = (W + BLOCK_X - 1) // BLOCK_X
+        grid_y = (H + BLOCK_Y - 1) // BLOCK_Y
+        xy = points_xy.detach()
+        rect_min_x = torch.clamp(((xy[:,0] - radii) / BLOCK_X).long(), 0, grid_x)
+        rect_min_y = torch.clamp(((xy[:,1] - radii) / BLOCK_Y).long(), 0, grid_y)
+        rect_max_x = torch.clamp(((xy[:,0] + radii + BLOCK_X - 1) / BLOCK_X).long(), 0, grid_x)
+        rect_max_y = torch.clamp(((xy[:,1] + radii + BLOCK_Y - 1) / BLOCK_Y).long(), 0, grid_y)
+        valid &= (rect_max_x - rect_min_x) * (rect_max_y - rect_min_y) > 0
+        radii = torch.where(valid, radii, torch.zeros_like(radii)).int()
+        rects = torch.stack([rect_min_x, rect_min_y, rect_max_x, rect_max_y], dim=1)
+
+    conic_opacity = torch.cat([conic, opacities.reshape((-1,1))], dim=1)
+    return z, points_xy, conic_opacity, radii, rects, valid
+
+def bin_tiles(depths, rects, valid, grid_x):
+    """
+    Duplicates every valid Gaussian once per tile its rectangle touches. Returns the Gaussian
+    of every (tile, Gaussian) pair, ordered by tile and front to back within a tile, and the
+    start of the pairs of every tile.
+    """
+    ids = torch.nonzero(valid)[:,0]
+    # Sorting by depth first and then stably by tile gives the (tile, depth) order of the CUDA key sort
+    ids = ids[torch.sort(depths[ids], stable=True).indices]
+    rects = rects[ids]
+    width = rects[:,2] - rects[:,0]
+    counts = width * (rects[:,3] - rects[:,1])
+
+    pair_gaussians = torch.repeat_interleave(ids, counts)
+    starts = torch.repeat_interleave(torch.cumsum(counts, dim=0) - counts, counts)
+    local = torch.arange(pair_gaussians.shape[0], device=ids.device) - starts
+    pair_rects = torch.repeat_interleave(rects, counts, dim=0)
+    pair_width = torch.repeat_interleave(width, counts)
+    tile_x = pair_rects[:,0] + local % torch.clamp(pair_width, min=1)
+    tile_y = pair_rects[:,1] + local // torch.clamp(pair_width, min=1)
+    pair_tiles = tile_y * grid_x + tile_x
+
+    order = torch.sort(pair_tiles, stable=True).indices
+    return pair_gaussians[order], pair_tiles[order]
+
+def composite_tiles(tiles, tile_starts, tile_counts, pair_gaussians, points_xy, conic_opacity, features, grid_x):
+    """
+    Front to back alpha compositing of the given tiles, all pixels of a tile and all its
+    Gaussians at once. Returns the accumulated features (T,256,C) and transmittance (T,256).
+    """
+    max_count = tile_counts.max().item()
+    slots = torch.arange(max_count, device=tiles.device)
+    in_list = slots.unsqueeze(0) < tile_counts.unsqueeze(1)
+    entries = torch.where(in_list, tile_starts.unsqueeze(1) + slots.unsqueeze(0), torch.zeros_like(in_list, dtype=torch.long))
+    gaussians = pair_gaussians[entries]
+
+    local_y, local_x = torch.meshgrid(torch.arange(BLOCK_Y, device=tiles.device), torch.arange(BLOCK_X, device=tiles.device), indexing="ij")
+    pixel_x = ((tiles % grid_x) * BLOCK_X).unsqueeze(1) + local_x.reshape((1,-1))
+    pixel_y = ((tiles // grid_x) * BLOCK_Y).unsqueeze(1) + local_y.reshape((1,-1))
+
+    # (T,256,L) Gaussian falloff at every pixel of the tile
+    xy = points_xy[gaussians]
+    d_x = xy[:,:,0].unsqueeze(1) - pixel_x.unsqueeze(2).to(xy)
+    d_y = xy[:,:,1].unsqueeze(1) - pixel_y.unsqueeze(2).to(xy)
+    con_o = conic_opacity[gaussians].unsqueeze(1)
+    power = -0.5 * (con_o[...,0] * d_x * d_x + con_o[...,2] * d_y * d_y) - con_o[...,1] * d_x * d_y
+
+    alpha = torch.clamp(con_o[...,3] * torch.exp(torch.clamp(power, max=0)), max=0.99)
+    skipped = (power > 0) | (alpha < 1.0 / 255.0) | ~in_list.unsqueeze(1)
+    alpha = torch.where(skipped, torch.zeros_like(alpha), alpha)
+
+    # A pixel is done at the first Gaussian that would take its transmittance below 1e-4,
+    # that Gaussian and all behind it are left out
+    transmittance = torch.cumprod(1 - alpha, dim=2)
+    done = transmittance < 0.0001
+    alpha = torch.where(done, torch.zeros_like(alpha), alpha)
+    transmittance = torch.cumprod(1 - alpha, dim=2)
+    before = torch.cat([torch.ones_like(transmittance[...,:1]), transmittance[...,:-1]], dim=2)
+
+    weights = alpha * before
+    color = weights @ features[gaussians]
+    return color, transmittance[...,-1]
+
+def rasterize(means3D, means2D, opacities, colors, cov3D, raster_settings, max_elements=2**24):
+    """
+    Differentiable tile based rasterization in PyTorch, following the CUDA rasterizer: tile
+    binning, sorting by depth within tiles and front to back compositing with the same alpha
+    thresholds and early termination. Returns the image (C,H,W) and the radii (N,).
+    Tiles are composited in chunks of about max_elements falloff values to bound memory.
+    """
+    W, H = raster_settings.image_width, raster_settings.image_height
+    grid_x = (W + BLOCK_X - 1) // BLOCK_X
+    grid_y = (H + BLOCK_Y - 1) // BLOCK_Y
+    bg = raster_settings.bg.to(colors)
+    num_channels = colors.shape[1]
+
+    depths, points_xy, conic_opacity, radii, rects, valid = preprocess(means3D, means2D, opacities, cov3D, raster_settings)
+    with torch.no_grad():
+        pair_gaussians, pair_tiles = bin_tiles(depths.detach(), rects, valid, grid_x)
+        tile_counts = torch.bincount(pair_tiles, minlength=grid_x*grid_y)
+        tile_starts = torch.cumsum(tile_counts, dim=0) - tile_counts
+        # Largest lists first, so that each chunk is padded to a similar length
+        tiles = torch.nonzero(tile_counts)[:,0]
+        tiles = tiles[torch.sort(tile_counts[tiles], descending=True, stable=True).indices]
+
+    tile_colors = torch.zeros((grid_x*grid_y, BLOCK_X*BLOCK_Y, num_channels), dtype=colors.dtype, device=colors.device)
+    tile_transmittance = torch.ones((grid_x*grid_y, BLOCK_X*BLOCK_Y), dtype=colors.dtype, device=colors.device)
+    start = 0
+    while start < tiles.shape[0]:
+        chunk_size = max(1, max_elements // (BLOCK_X*BLOCK_Y*tile_counts[tiles[start]].item()))
+        chunk = tiles[start:start+chunk_size]
+        color, transmittance = composite_tiles(chunk, tile_starts[chunk], tile_counts[chunk], pair_gaussians, points_xy, conic_opacity, colors, grid_x)
+        tile_colors = tile_colors.index_copy(0, chunk, color)
+        tile_transmittance = tile_transmittance.index_copy(0, chunk, transmittance)
+        start += chunk_size
+
+    image = tile_colors + tile_transmittance.unsqueeze(2) * bg
+    image = image.reshape((grid_y, grid_x, BLOCK_Y, BLOCK_X, num_channels)).permute(4,0,2,1,3)
+    image = image.reshape((num_channels, grid_y*BLOCK_Y, grid_x*BLOCK_X))[:, :H, :W]
+    return image, radii
+
+class TorchGaussianRasterizer(torch.nn.Module):
+    """
+    Drop-in replacement for diff_gaussian_rasterization.GaussianRasterizer written in PyTorch,
+    for machines without the CUDA extension or without a GPU. Gradients come from autograd.
+    Rasterizing with a texture camera is only available in the CUDA rasterizer.
+    """
+    def __init__(self, raster_settings, max_elements=2**24):
+        super().__init__()
+        self.raster_settings = raster_settings
+        self.max_elements = max_elements
+
+    def markVisible(self, positions):
+        with torch.no_grad():
+            viewmatrix = self.raster_settings.viewmatrix.to(positions)
+            return (positions @ viewmatrix[:3,2] + viewmatrix[3,2]) > 0.2
+
+    def forward(self, means3D, means2D, opacities, texture=None, texture_proj_mat=None, shs = None, colors_precomp = None, scales = None, rotations = None, cov3D_precomp = None):
+        raster_settings = self.raster_settings
+
+        if (shs is None and colors_precomp is None) or (shs is not None and colors_precomp is not None):
+            raise Exception('Please provide excatly one of either SHs or precomputed colors!')
+
+        if ((scales is None or rotations is None) and cov3D_precomp is None) or ((scales is not None or rotations is not None) and cov3D_precomp is not None):
+            raise Exception('Please provide exactly one of either scale/rotation pair or precomputed 3D covariance!')
+
+        if texture is not None:
+            raise NotImplementedError("Texture camera rasterization needs the CUDA rasterizer")
+
+        if colors_precomp is None:
+            # As computeColorFromSH, the remaining channels of the background are left empty
+            dirs = means3D - raster_settings.campos.to(means3D)
+            dirs = dirs / dirs.norm(dim=1, keepdim=True)
+            colors_precomp = torch.clamp_min(eval_sh(raster_settings.sh_degree, shs.transpose(1, 2), dirs) + 0.5, 0.0)
+            padding = raster_settings.bg.shape[0] - colors_precomp.shape[1]
+            colors_precomp = torch.cat([colors_precomp, torch.zeros_like(colors_precomp[:,:1]).expand((-1, padding))], dim=1)
+
+        if cov3D_precomp is not None:
+            cov3D = unpack_covariance(cov3D_precomp)
+        else:
+            cov3D = build_covariance(scales, rotations, raster_settings.scale_modifier)
+
+        return rasterize(means3D, means2D, opacities, colors_precomp, cov3D, raster_settings, self.max_elements)
@@ -15,20 +15,21 @@ from scene import Scene
 import os
 from tqdm import tqdm
 from os import makedirs
-from gaussian_renderer import render
-from textured_render import prerender_depth, textured_render_multicam, textured_render_per_gaussian
+from gaussian_renderer import render, render_batch
+from textured_render import GaussianTextureCoords, build_visibility_index, depth_cache, enable_compiled_kernels, load_camera_selection, prerender_depth, textured_render_multicam, textured_render_per_gaussian, textured_render_precomputed
 import torchvision
 from utils.general_utils import farthest_point_down_sample, safe_state
 from argparse import ArgumentParser
 from arguments import ModelParams, PipelineParams, get_combined_args
 from gaussian_renderer import GaussianModel
+from scene.camera_index import CameraIndex
 import cv2
 import numpy as np
 
 from utils.image_utils import psnr
 from utils.loss_utils import gaussian, l2_loss
 
-def render_set(model_path, name, iteration, views,texture_views,gaussians, pipeline, background, blend_mode, render_type,ablations):
+def render_set(model_path, name, iteration, views,texture_views,gaussians, pipeline, background, blend_mode, render_type,ablations,inpaint_mode,texture_coords=None):
     approach = f"{render_type}_{blend_mode}_{iteration}_{len(texture_views)}"
     if len(ablations)>0:
         approach += "_"+"_".join(ablations)
@@ -44,6 +45,8 @@ def render_set(model_path, name, iteration, views,texture_views,gaussians, pipel
         f.write(str(len(gaussians.get_xyz)))
 
     psnrs = []
+    if render_type not in ["texture", "texture_per_gaussian", "texture_precomputed"]:
+        plain_renders = render_batch(views, gaussians, pipeline, background, normalize_depth=(render_type != "depth_not_normalized"))
     for idx, view in enumerate(tqdm(views, desc="Rendering progress")):
         #import dill
         print(idx,view.image_name)
@@ -57,7 +60,7 @@ def render_set(model_path, name, iteration, views,texture_views,gaussians, pipel
         #texture_views = views[1:]
 
         if render_type == "texture":
-            rendering_pkg = textured_render_multicam(view, texture_views,gaussians, pipeline, background,in_training=(name=="train"),blend_mode=blend_mode,ablations=ablations)
+            rendering_pkg = textured_render_multicam(view, texture_views,gaussians, pipeline, background,in_training=(name=="train"),blend_mode=blend_mode,ablations=ablations,inpaint_mode=inpaint_mode,adaptive_texture_views=args.adaptive_texture_views,sparse=args.sparse,tile_size=args.tile_size,visibility_selection=args.visibility_selection,outputs=["render_textured","render_textured_mask","before_blend","render_textured_in_frame"])
             
             if args.inpaint:
                 render_textured = cv2.inpaint(
@@ -88,18 +91,23 @@ def render_set(model_path, name, iteration, views,texture_views,gaussians, pipel
             torchvision.utils.save_image(0.1*render(view, gaussians, pipeline, background,render_depth=True,depth_exp=1.0)["render_depth"], os.path.join(render_path, '{0:05d}'.format(idx) + "_depth1.0.png"))
             torchvision.utils.save_image(rendering_pkg["render_opacity"], os.path.join(render_path, '{0:05d}'.format(idx) + "_opacity.png"))
             psnrs.append(psnr(view.original_image, rendering_pkg["render_textured"]).mean().item())
+        elif render_type == "texture_precomputed":
+            rendering_pkg = textured_render_precomputed(view, texture_coords, gaussians, pipeline, background, blend_mode=blend_mode)
+            torchvision.utils.save_image(rendering_pkg["render_textured"], os.path.join(render_path, '{0:05d}'.format(idx) + "_texture.png"))
+            torchvision.utils.save_image(rendering_pkg["render_opacity"], os.path.join(render_path, '{0:05d}'.format(idx) + "_opacity.png"))
+            psnrs.append(psnr(view.original_image, rendering_pkg["render_textured"]).mean().item())
         elif render_type == "depth_not_normalized":
-            rendering_pkg = render(view, gaussians, pipeline, background,render_depth=True, normalize_depth=False)
+            rendering_pkg = next(plain_renders)
             rendering_pkg["render_depth"]
             psnrs.append(l2_loss(view.depth, rendering_pkg["render_depth"].cpu()).mean().item())
         elif render_type == "depth":
-            rendering_pkg = render(view, gaussians, pipeline, background,render_depth=True)
+            rendering_pkg = next(plain_renders)
             rendering_pkg["render_depth"]
             psnrs.append(l2_loss(view.depth, rendering_pkg["render_depth"].cpu()).mean().item())
         else:
-            rendering_pkg = render(view, gaussians, pipeline, background,render_depth=True)
+            rendering_pkg = next(plain_renders)
             #torchvision.utils.save_image(0.1*render(view, gaussians, pipeline, background,render_depth=True,depth_exp=0.25)["render_depth"]**4, os.path.join(render_path, '{0:05d}'.format(idx) + "_depth0.5.png"))
-            torchvision.utils.save_image(0.1*render(view, gaussians, pipeline, background,render_depth=True,depth_exp=1.0)["render_depth"], os.path.join(render_path, '{0:05d}'.format(idx) + "_depth1.0.png"))
+            torchvision.utils.save_image(0.1*rendering_pkg["render_depth"], os.path.join(render_path, '{0:05d}'.format(idx) + "_depth1.0.png"))
             #torchvision.utils.save_image(render(view, gaussians, pipeline, background,render_depth=True,depth_exp=4.0)["render_depth"]**0.25-rendering_pkg["render_depth"], os.path.join(render_path, '{0:05d}'.format(idx) + "_depth2.png"),normalize=True)
             
 
@@ -112,8 +120,10 @@ def render_set(model_path, name, iteration, views,texture_views,gaussians, pipel
         if view.depth is not None:
             torchvision.utils.save_image(view.depth*0.1, os.path.join(render_path, '{0:05d}'.format(idx) + "gtdepth.png"))
     print("Mean PSNR:",np.mean(psnrs))
+    if render_type == "texture":
+        print("Depth cache:", depth_cache.stats())
     
-def render_sets(dataset : ModelParams, iteration : int, pipeline : PipelineParams, skip_train : bool, skip_test : bool,blend_mode, render_type, train_images, ablations):
+def render_sets(dataset : ModelParams, iteration : int, pipeline : PipelineParams, skip_train : bool, skip_test : bool,blend_mode, render_type, train_images, ablations, inpaint_mode):
     with torch.no_grad():
         gaussians = GaussianModel(dataset.sh_degree)
         scene = Scene(dataset, gaussians, load_iteration=iteration, shuffle=False)
@@ -125,17 +135,28 @@ def render_sets(dataset : ModelParams, iteration : int, pipeline : PipelineParam
         background = torch.tensor(bg_color, dtype=torch.float32, device="cuda")
 
         prerender_depth(scene.getTrainCameras(), gaussians, pipeline, background)
+        if render_type == "texture" and args.visibility_selection:
+            visibility_index = build_visibility_index(gaussians, scene.getTrainCameras(), pipeline, background)
+            print(f"Visibility index: {visibility_index.memory_mb():.1f} MB")
         
         render_images = scene.getTrainCameras()
         
-        render_images_subset = farthest_point_down_sample(torch.stack([c.camera_center.cpu() for c in render_images]), train_images)
-        render_images = [render_images[i] for i in render_images_subset]
+        if args.texture_selection:
+            # Written by select_texture_views.py
+            render_images = CameraIndex(load_camera_selection(os.path.join(dataset.model_path, "texture_views.json"), render_images))
+        else:
+            render_images_subset = farthest_point_down_sample(torch.stack([c.camera_center.cpu() for c in render_images]), train_images)
+            render_images = CameraIndex([render_images[i] for i in render_images_subset])
+
+        texture_coords = None
+        if render_type == "texture_precomputed":
+            texture_coords = GaussianTextureCoords.build(gaussians, render_images, (gaussians, pipeline, background), num_cameras=args.precomputed_texture_views)
         
         if not skip_train:
-             render_set(dataset.model_path, "train", scene.loaded_iter, scene.getTrainCameras(),render_images, gaussians, pipeline, background,blend_mode, render_type,ablations)
+             render_set(dataset.model_path, "train", scene.loaded_iter, scene.getTrainCameras(),render_images, gaussians, pipeline, background,blend_mode, render_type,ablations,inpaint_mode,texture_coords)
 
         if not skip_test:
-             render_set(dataset.model_path, "test", scene.loaded_iter, scene.getTestCameras(),render_images, gaussians, pipeline, background, blend_mode,render_type,ablations)
+             render_set(dataset.model_path, "test", scene.loaded_iter, scene.getTestCameras(),render_images, gaussians, pipeline, background, blend_mode,render_type,ablations,inpaint_mode,texture_coords)
 
 if __name__ == "__main__":
     # Set up command line argument parser
@@ -150,12 +171,21 @@ if __name__ == "__main__":
     parser.add_argument("--mode", default="normal",type=str)
     parser.add_argument("--ablations", nargs='+', default=[])
     parser.add_argument("--inpaint", action="store_true")
+    parser.add_argument("--inpaint_mode", default="push_pull", choices=["push_pull", "push_pull_blur", "blur"])
+    parser.add_argument("--adaptive_texture_views", action="store_true")
+    parser.add_argument("--sparse", action="store_true")
+    parser.add_argument("--tile_size", default=None, type=int)
     parser.add_argument("--train_images", default=1000, type=int)
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--visibility_selection", action="store_true")
+    parser.add_argument("--precomputed_texture_views", default=8, type=int)
+    parser.add_argument("--texture_selection", action="store_true")
     args = get_combined_args(parser)
     print("Rendering " + args.model_path)
     print(args.ablations)
     render_type = args.mode
     # Initialize system state (RNG)
     safe_state(args.quiet)
+    enable_compiled_kernels(args.compile)
 
-    render_sets(model.extract(args), args.iteration, pipeline.extract(args), args.skip_train, args.skip_test, args.blend_mode, render_type, args.train_images,args.ablations)
\ No newline at end of file
+    render_sets(model.extract(args), args.iteration, pipeline.extract(args), args.skip_train, args.skip_test, args.blend_mode, render_type, args.train_images,args.ablations,args.inpaint_mode)
\ No newline at end of file
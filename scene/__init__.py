@@ -19,7 +19,7 @@ from scene.dataset_readers import readNerfSyntheticInfo, readTUMSceneInfo, scene
 from scene.gaussian_model import GaussianModel
 from arguments import ModelParams
 from utils.camera_utils import cameraList_from_camInfos, camera_to_JSON
-from depth_images import camera_to_pcd
+from depth_images import cameras_to_pcd
 import torch
 
 class Scene:
@@ -110,13 +110,7 @@ class Scene:
             elif args.initialisation == "colmap":
                 self.gaussians.create_from_pcd(scene_info.point_cloud, self.cameras_extent,max_gaussians=args.start_gaussians)
             elif args.initialisation == "depth":
-                all_points = []
-                all_colors = []
-                for camera in self.getTrainCameras():
-                    points, colors = camera_to_pcd(camera)
-
-                    all_points.append(points)
-                    all_colors.append(colors)
+                all_points, all_colors = cameras_to_pcd(self.getTrainCameras())
                 pcd = BasicPointCloud(points=(torch.cat(all_points).cpu()), colors=torch.cat(all_colors).cpu(), normals=torch.cat(all_points), visible_in_cameras=None)
                 self.gaussians.create_from_pcd(pcd, self.cameras_extent,max_gaussians=args.start_gaussians)
             else:
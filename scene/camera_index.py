@@ -0,0 +1,94 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import torch
+from depth_images import camera_frustrum_points
+
+class CameraIndex:
+    """
+    Stacked centers and frusta of a fixed list of cameras, answering nearest camera
+    and frustum overlap queries with one vectorized call instead of a Python sort.
+    """
+    def __init__(self, cameras):
+        self.cameras = list(cameras)
+        self.camera_centers = torch.stack([cam.camera_center for cam in self.cameras])
+        self.world_view_transforms = torch.stack([cam.world_view_transform for cam in self.cameras])
+        self.intrinsics = torch.stack([cam.get_proj_mat() for cam in self.cameras]).to(self.camera_centers)
+        self.image_sizes = torch.tensor(
+            [[cam.image_width, cam.image_height] for cam in self.cameras],
+            dtype=self.camera_centers.dtype,
+            device=self.camera_centers.device
+        )
+        self.positions = {id(cam): i for i, cam in enumerate(self.cameras)}
+        self.neighbors = None
+
+    def __len__(self):
+        return len(self.cameras)
+
+    def __iter__(self):
+        return iter(self.cameras)
+
+    def __getitem__(self, idx):
+        return self.cameras[idx]
+
+    def position(self, camera):
+        return self.positions.get(id(camera))
+
+    def distances(self, point):
+        return torch.norm(self.camera_centers - point, dim=1)
+
+    def nearest(self, point, k, skip=0):
+        # Stable, so that ties keep the order of the camera list like list.sort did
+        order = torch.sort(self.distances(point), stable=True).indices
+        return order[skip:k+skip]
+
+    def neighbor_table(self, k):
+        """
+        Indices of the k+1 closest cameras to every camera, the camera itself included.
+        Computed once for the largest k requested.
+        """
+        if self.neighbors is None or self.neighbors.shape[1] < min(k+1, len(self)):
+            dists = torch.cdist(self.camera_centers, self.camera_centers)
+            self.neighbors = torch.sort(dists, dim=1, stable=True).indices[:,:k+1]
+        return self.neighbors[:,:k+1]
+
+    def frustum_overlap(self, camera, min_points=10):
+        """
+        Mask of the cameras that see more than min_points of the frustum points of camera.
+        """
+        points = camera_frustrum_points(camera)
+        points_hom = torch.cat([points, torch.ones_like(points[:,:1])], dim=1)
+        cam_points = torch.matmul(points_hom.unsqueeze(0), self.world_view_transforms)
+        cam_points = cam_points[...,:3] / (cam_points[...,3:] + 0.0000001)
+        pixels = torch.matmul(cam_points, self.intrinsics.transpose(1,2))
+        depth = pixels[...,2]
+        pixels = pixels[...,:2] / (depth.unsqueeze(2) + 1e-9)
+
+        size = self.image_sizes.unsqueeze(1)
+        inside = (depth > 0) & (pixels >= 0).all(dim=2) & (pixels < size).all(dim=2)
+        return inside.sum(dim=1) > min_points
+
+    def select(self, viewpoint_camera, num, skip_self=False, frustum_culling=False):
+        """
+        Indices of the num cameras closest to viewpoint_camera. With skip_self the closest
+        camera, normally viewpoint_camera itself, is left out.
+        """
+        position = self.position(viewpoint_camera)
+        if skip_self and position is not None and not frustum_culling:
+            return self.neighbor_table(num)[position,1:num+1]
+
+        order = self.nearest(viewpoint_camera.camera_center, len(self))
+        if frustum_culling:
+            order = order[self.frustum_overlap(viewpoint_camera)[order]]
+        return order[int(skip_self):num+int(skip_self)]
+
+    def select_cameras(self, viewpoint_camera, num, skip_self=False, frustum_culling=False):
+        return [self.cameras[i] for i in self.select(viewpoint_camera, num, skip_self, frustum_culling).tolist()]
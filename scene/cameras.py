@@ -14,11 +14,12 @@ from torch import bilinear, nn
 import numpy as np
 from utils.general_utils import inverse_sigmoid
 from utils.graphics_utils import getWorld2View2, getProjectionMatrix, fov2focal
+from utils.texture_pyramid import build_packed_scales
 
 class Camera(nn.Module):
     def __init__(self, colmap_id, R, T, FoVx, FoVy, image,depth, gt_alpha_mask,
                  image_name, uid,
-                 trans=np.array([0.0, 0.0, 0.0]), scale=1.0, data_device = "cpu"
+                 trans=np.array([0.0, 0.0, 0.0]), scale=1.0, data_device = "cpu", texture_dtype=torch.float32
                  ):
         super(Camera, self).__init__()
 
@@ -48,10 +49,6 @@ class Camera(nn.Module):
         # self.original_image[:,:,:] = torch.linspace(0,2,self.image_height).reshape((1,self.image_height,1))
         # self.original_image[:,self.image_height//2:,:]-=1
         
-        self.image_scales = [self.original_image]
-        for _ in range(5):
-            self.image_scales.append(torch.nn.functional.interpolate(self.image_scales[-1].unsqueeze(0),scale_factor=0.5,mode="area").squeeze())
-            
         #self.learnable_image = torch.nn.Parameter(inverse_sigmoid(self.original_image).clone())
         self.learnable_image = None
         if gt_alpha_mask is not None:
@@ -59,6 +56,14 @@ class Camera(nn.Module):
         else:
             self.original_image *= torch.ones((1, self.image_height, self.image_width), device=self.data_device)
 
+        # The texture pyramid is downsampled in float32 and stored in texture_dtype, texture
+        # sampling and blending upcast to float32. All levels share one allocation. original_image,
+        # the ground truth of losses and metrics, stays in float32: it is only a view of the first
+        # level if that is float32.
+        self.image_scales = build_packed_scales(self.original_image, dtype=texture_dtype)
+        if texture_dtype == torch.float32:
+            self.original_image = self.image_scales[0]
+
         self.zfar = 100.0
         self.znear = 0.01
 
@@ -17,7 +17,11 @@ import os
 from utils.system_utils import mkdir_p
 from plyfile import PlyData, PlyElement
 from utils.sh_utils import RGB2SH
-from simple_knn._C import distCUDA2
+try:
+    from simple_knn._C import distCUDA2
+except ImportError:
+    # Only needed to initialise from a point cloud, loading and rendering trained models works without it
+    distCUDA2 = None
 from utils.graphics_utils import BasicPointCloud
 from utils.general_utils import strip_symmetric, build_scaling_rotation
 
@@ -59,6 +63,14 @@ class GaussianModel:
         self.percent_dense = 0
         self.spatial_lr_scale = 0
         self.depth_scale = torch.tensor(0)
+        # Incremented whenever the Gaussians change, so that caches of derived data can be invalidated
+        self.version = 0
+        # Optional VisibilityIndex, kept in step with pruning and densification
+        self.visibility_index = None
+        # Activated tensors of the current version, only used while gradients are disabled
+        self.use_activation_cache = True
+        self.activation_cache = {}
+        self.activation_cache_version = None
         self.setup_functions()
 
     def capture(self):
@@ -94,14 +106,33 @@ class GaussianModel:
         self.xyz_gradient_accum = xyz_gradient_accum
         self.denom = denom
         self.optimizer.load_state_dict(opt_dict)
+        self.visibility_index = None
+        self.bump_version()
+
+    def bump_version(self):
+        self.version += 1
+
+    def cached_activation(self, name, compute):
+        """
+        compute(), cached until the next bump_version. Tensors computed with gradients enabled
+        belong to the graph of one iteration, so they are never cached.
+        """
+        if not self.use_activation_cache or torch.is_grad_enabled():
+            return compute()
+        if self.activation_cache_version != self.version:
+            self.activation_cache = {}
+            self.activation_cache_version = self.version
+        if name not in self.activation_cache:
+            self.activation_cache[name] = compute()
+        return self.activation_cache[name]
 
     @property
     def get_scaling(self):
-        return self.scaling_activation(self._scaling)
+        return self.cached_activation("scaling", lambda: self.scaling_activation(self._scaling))
     
     @property
     def get_rotation(self):
-        return self.rotation_activation(self._rotation)
+        return self.cached_activation("rotation", lambda: self.rotation_activation(self._rotation))
     
     @property
     def get_xyz(self):
@@ -111,11 +142,11 @@ class GaussianModel:
     def get_features(self):
         features_dc = self._features_dc
         features_rest = self._features_rest
-        return torch.cat((features_dc, features_rest), dim=1)
+        return self.cached_activation("features", lambda: torch.cat((features_dc, features_rest), dim=1))
     
     @property
     def get_opacity(self):
-        return self.opacity_activation(self._opacity)
+        return self.cached_activation("opacity", lambda: self.opacity_activation(self._opacity))
     
     def get_covariance(self, scaling_modifier = 1):
         return self.covariance_activation(self.get_scaling, scaling_modifier, self._rotation)
@@ -162,6 +193,8 @@ class GaussianModel:
         self._opacity = nn.Parameter(opacities.requires_grad_(True))
         self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device="cuda")
         self.depth_scale = nn.Parameter(torch.zeros((1,),device="cuda"))
+        self.visibility_index = None
+        self.bump_version()
 
     def training_setup(self, training_args, learnable_images):
         self.percent_dense = training_args.percent_dense
@@ -233,6 +266,7 @@ class GaussianModel:
         opacities_new = inverse_sigmoid(torch.min(self.get_opacity, torch.ones_like(self.get_opacity)*0.01))
         optimizable_tensors = self.replace_tensor_to_optimizer(opacities_new, "opacity")
         self._opacity = optimizable_tensors["opacity"]
+        self.bump_version()
 
     def load_ply(self, path):
         plydata = PlyData.read(path)
@@ -281,6 +315,8 @@ class GaussianModel:
 
         self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device="cuda")
         self.depth_scale = nn.Parameter(torch.zeros((1,),device="cuda"))
+        self.visibility_index = None
+        self.bump_version()
 
 
 
@@ -334,6 +370,9 @@ class GaussianModel:
 
         self.denom = self.denom[valid_points_mask]
         self.max_radii2D = self.max_radii2D[valid_points_mask]
+        self.bump_version()
+        if self.visibility_index is not None:
+            self.visibility_index.prune(valid_points_mask, self.version)
 
     def cat_tensors_to_optimizer(self, tensors_dict):
         optimizable_tensors = {}
@@ -359,7 +398,7 @@ class GaussianModel:
 
         return optimizable_tensors
 
-    def densification_postfix(self, new_xyz, new_features_dc, new_features_rest, new_opacities, new_scaling, new_rotation):
+    def densification_postfix(self, new_xyz, new_features_dc, new_features_rest, new_opacities, new_scaling, new_rotation, parents=None):
         d = {"xyz": new_xyz,
         "f_dc": new_features_dc,
         "f_rest": new_features_rest,
@@ -378,6 +417,13 @@ class GaussianModel:
         self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
         self.denom = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
         self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device="cuda")
+        self.bump_version()
+        if self.visibility_index is not None:
+            # Without the Gaussians the new ones come from, their visibility is unknown
+            if parents is None:
+                self.visibility_index = None
+            else:
+                self.visibility_index.append(parents, self.version)
 
     def densify_and_split(self, grads, grad_threshold, scene_extent, N=2):
         n_init_points = self.get_xyz.shape[0]
@@ -398,8 +444,9 @@ class GaussianModel:
         new_features_dc = self._features_dc[selected_pts_mask].repeat(N,1,1)
         new_features_rest = self._features_rest[selected_pts_mask].repeat(N,1,1)
         new_opacity = self._opacity[selected_pts_mask].repeat(N,1)
+        parents = torch.nonzero(selected_pts_mask)[:,0].repeat(N)
 
-        self.densification_postfix(new_xyz, new_features_dc, new_features_rest, new_opacity, new_scaling, new_rotation)
+        self.densification_postfix(new_xyz, new_features_dc, new_features_rest, new_opacity, new_scaling, new_rotation, parents)
 
         prune_filter = torch.cat((selected_pts_mask, torch.zeros(N * selected_pts_mask.sum(), device="cuda", dtype=bool)))
         self.prune_points(prune_filter)
@@ -416,10 +463,11 @@ class GaussianModel:
         new_opacities = self._opacity[selected_pts_mask]
         new_scaling = self._scaling[selected_pts_mask]
         new_rotation = self._rotation[selected_pts_mask]
+        parents = torch.nonzero(selected_pts_mask)[:,0]
 
-        self.densification_postfix(new_xyz, new_features_dc, new_features_rest, new_opacities, new_scaling, new_rotation)
+        self.densification_postfix(new_xyz, new_features_dc, new_features_rest, new_opacities, new_scaling, new_rotation, parents)
 
-    def densify_and_prune(self, max_grad, min_opacity, extent, max_screen_size):
+    def densify_and_prune(self, max_grad, min_opacity, extent, max_screen_size, min_views=0):
         grads = self.xyz_gradient_accum / self.denom
         grads[grads.isnan()] = 0.0
 
@@ -431,6 +479,9 @@ class GaussianModel:
             big_points_vs = self.max_radii2D > max_screen_size
             big_points_ws = self.get_scaling.max(dim=1).values > 0.1 * extent
             prune_mask = torch.logical_or(torch.logical_or(prune_mask, big_points_vs), big_points_ws)
+        if min_views > 0 and self.visibility_index is not None:
+            # Gaussians seen by too few training cameras
+            prune_mask = torch.logical_or(prune_mask, self.visibility_index.view_counts() < min_views)
         self.prune_points(prune_mask)
 
         torch.cuda.empty_cache()
@@ -0,0 +1,165 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import torch
+
+def counts_to_indptr(counts):
+    return torch.cat([torch.zeros(1,dtype=torch.long,device=counts.device), torch.cumsum(counts,dim=0)])
+
+class VisibilityIndex:
+    """
+    For every Gaussian, the cameras that see its center unoccluded, in CSR form: the cameras
+    of Gaussian i are cameras[indices[indptr[i]:indptr[i+1]]].
+
+    The index is built for one model version. prune and append keep it in step with
+    prune_points and densification_postfix, new Gaussians inheriting the visibility of the
+    Gaussian they were cloned or split from. Moves of the Gaussians by optimizer steps are
+    not tracked, call build again to refresh it.
+    """
+    def __init__(self, cameras, indptr, indices, version):
+        self.cameras = list(cameras)
+        self.indptr = indptr
+        self.indices = indices
+        self.version = version
+
+    @classmethod
+    def build(cls, pc, cameras, render_depth, depth_tol=0.05):
+        """
+        render_depth(camera) returns the rendered depth (1,H,W) of camera. A Gaussian is visible
+        from a camera if its center projects inside the image, with a depth within a fraction
+        depth_tol of the rendered depth there, so that the test holds at any distance.
+        """
+        xyz = pc.get_xyz.detach()
+        points_hom = torch.cat([xyz, torch.ones_like(xyz[:,:1])], dim=1)
+
+        gaussian_ids = []
+        camera_ids = []
+        with torch.no_grad():
+            for i, camera in enumerate(cameras):
+                points_camera = points_hom @ camera.world_view_transform
+                depth = points_camera[:,2]
+                pixels = points_camera[:,:3] @ camera.get_proj_mat().to(xyz).T
+                pixels = (pixels[:,:2] / (pixels[:,2:] + 1e-9)).round().long()
+
+                rendered_depth = render_depth(camera)[0]
+                h, w = rendered_depth.shape
+                in_frame = (depth > 0) & (pixels[:,0] >= 0) & (pixels[:,0] < w) & (pixels[:,1] >= 0) & (pixels[:,1] < h)
+
+                candidates = torch.nonzero(in_frame)[:,0]
+                target_depth = rendered_depth[pixels[candidates,1], pixels[candidates,0]]
+                visible = candidates[torch.abs(depth[candidates] - target_depth) < depth_tol*depth[candidates]]
+
+                gaussian_ids.append(visible)
+                camera_ids.append(torch.full_like(visible, i, dtype=torch.int32))
+
+        gaussian_ids = torch.cat(gaussian_ids)
+        camera_ids = torch.cat(camera_ids)
+        order = torch.sort(gaussian_ids, stable=True).indices
+        counts = torch.bincount(gaussian_ids, minlength=xyz.shape[0])
+        return cls(cameras, counts_to_indptr(counts), camera_ids[order], pc.version)
+
+    def __len__(self):
+        return self.indptr.shape[0] - 1
+
+    def is_current(self, pc):
+        return self.version == pc.version and len(self) == pc.get_xyz.shape[0]
+
+    def view_counts(self):
+        """
+        Number of cameras that see each Gaussian.
+        """
+        return self.indptr[1:] - self.indptr[:-1]
+
+    def visible_from(self, camera_id):
+        """
+        Mask of the Gaussians seen by cameras[camera_id].
+        """
+        rows = torch.repeat_interleave(torch.arange(len(self), device=self.indptr.device), self.view_counts())
+        mask = torch.zeros(len(self), dtype=torch.bool, device=self.indptr.device)
+        mask[rows[self.indices == camera_id]] = True
+        return mask
+
+    def camera_coverage(self, gaussian_mask):
+        """
+        For every camera, how many of the Gaussians in gaussian_mask it sees.
+        """
+        entries = torch.repeat_interleave(gaussian_mask, self.view_counts())
+        return torch.bincount(self.indices[entries], minlength=len(self.cameras))
+
+    def select(self, gaussian_mask, num, exclude=None):
+        """
+        Indices of the num cameras that see most of the Gaussians in gaussian_mask, best first.
+        Cameras that see none of them, and the camera exclude, are left out.
+        """
+        coverage = self.camera_coverage(gaussian_mask)
+        if exclude is not None:
+            for i, camera in enumerate(self.cameras):
+                if camera is exclude:
+                    coverage[i] = 0
+        order = torch.sort(coverage, descending=True, stable=True).indices
+        return order[coverage[order] > 0][:num]
+
+    def select_cameras(self, gaussian_mask, num, exclude=None):
+        return [self.cameras[i] for i in self.select(gaussian_mask, num, exclude).tolist()]
+
+    def greedy_cover(self, target_coverage=0.99, costs=None, budget=None):
+        """
+        Greedy set cover: picks the camera that sees most of the still uncovered Gaussians until
+        target_coverage of the Gaussians seen by any camera is covered. With costs and budget,
+        cameras whose cost no longer fits in the remaining budget are skipped.
+        Returns the picked camera indices, in order, and the covered fraction.
+        """
+        seen = self.view_counts() > 0
+        total = max(seen.sum().item(), 1)
+        uncovered = seen.clone()
+        available = torch.ones(len(self.cameras), dtype=torch.bool, device=self.indptr.device)
+        remaining = budget
+
+        selection = []
+        while 1 - uncovered.sum().item()/total < target_coverage:
+            if costs is not None and remaining is not None:
+                available &= costs.to(available.device) <= remaining
+            coverage = self.camera_coverage(uncovered) * available
+            best = torch.argmax(coverage).item()
+            if coverage[best] == 0:
+                break
+            selection.append(best)
+            available[best] = False
+            uncovered &= ~self.visible_from(best)
+            if remaining is not None:
+                remaining -= costs[best].item()
+        return selection, 1 - uncovered.sum().item()/total
+
+    def prune(self, valid_mask, version):
+        """
+        Drops the Gaussians that are not in valid_mask, as prune_points does.
+        """
+        counts = self.view_counts()
+        self.indices = self.indices[torch.repeat_interleave(valid_mask, counts)]
+        self.indptr = counts_to_indptr(counts[valid_mask])
+        self.version = version
+
+    def append(self, parents, version):
+        """
+        Adds one Gaussian per entry of parents, seen by the same cameras as that parent.
+        """
+        counts = self.view_counts()
+        new_counts = counts[parents]
+        new_indptr = counts_to_indptr(new_counts)
+        offsets = torch.arange(new_indptr[-1].item(), device=counts.device) - torch.repeat_interleave(new_indptr[:-1], new_counts)
+        entries = torch.repeat_interleave(self.indptr[parents], new_counts) + offsets
+
+        self.indices = torch.cat([self.indices, self.indices[entries]])
+        self.indptr = counts_to_indptr(torch.cat([counts, new_counts]))
+        self.version = version
+
+    def memory_mb(self):
+        return (self.indptr.numel()*self.indptr.element_size() + self.indices.numel()*self.indices.element_size()) / 1024**2
@@ -0,0 +1,55 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import os
+import torch
+from argparse import ArgumentParser
+from arguments import ModelParams, PipelineParams, get_combined_args
+from depth_images import calibrate_depth
+from gaussian_renderer import GaussianModel
+from scene import Scene
+from textured_render import save_camera_selection, select_covering_cameras
+from utils.general_utils import safe_state
+
+def select_texture_views(dataset : ModelParams, iteration : int, pipeline : PipelineParams, target_coverage, memory_budget_mb, depth_tol):
+    with torch.no_grad():
+        gaussians = GaussianModel(dataset.sh_degree)
+        scene = Scene(dataset, gaussians, load_iteration=iteration, shuffle=False)
+        calibrate_depth(scene)
+
+        bg_color = [1,1,1] if dataset.white_background else [0, 0, 0]
+        background = torch.tensor(bg_color, dtype=torch.float32, device="cuda")
+
+        cameras, summary = select_covering_cameras(gaussians, scene.getTrainCameras(), pipeline, background, target_coverage, memory_budget_mb, depth_tol)
+        summary["iteration"] = scene.loaded_iter
+
+    path = os.path.join(dataset.model_path, "texture_views.json")
+    save_camera_selection(path, summary)
+    print(f"Selected {len(cameras)} of {summary['num_cameras']} cameras, coverage {summary['coverage']:.4f}, {summary['memory_mb']:.1f} MB of textures")
+    print("Saved to", path)
+
+if __name__ == "__main__":
+    # Set up command line argument parser
+    parser = ArgumentParser(description="Selects the texture cameras that cover the scene surface")
+    model = ModelParams(parser, sentinel=True)
+    pipeline = PipelineParams(parser)
+    parser.add_argument("--iteration", default=-1, type=int)
+    parser.add_argument("--target_coverage", default=0.99, type=float)
+    parser.add_argument("--memory_budget_mb", default=None, type=float)
+    parser.add_argument("--depth_tol", default=0.05, type=float)
+    parser.add_argument("--quiet", action="store_true")
+    args = get_combined_args(parser)
+    print("Selecting texture views for " + args.model_path)
+
+    # Initialize system state (RNG)
+    safe_state(args.quiet)
+
+    select_texture_views(model.extract(args), args.iteration, pipeline.extract(args), args.target_coverage, args.memory_budget_mb, args.depth_tol)
@@ -1,16 +1,26 @@
 
 import torch
 import math
-from diff_gaussian_rasterization import GaussianRasterizationSettings, GaussianRasterizer
+import json
+from collections import OrderedDict
 from scene.gaussian_model import GaussianModel
 from utils.sh_utils import eval_sh
 from utils.graphics_utils import geom_transform_points
-from gaussian_renderer import render
+from gaussian_renderer import render, render_depths
 import torchvision
-from depth_images import camera_frustrum_points, depth_image_to_point_cloud
+from depth_images import camera_frustrum_points, depth_image_to_point_cloud, reserve_camera_rays
+from utils.depth_cache import DepthCache
+from utils.texture_pyramid import build_scales
+from scene.camera_index import CameraIndex
+from scene.visibility_index import VisibilityIndex
+from utils.general_utils import enable_compiled_kernels, kernel
+from blending import StreamingBlend, blend_stack, blend_weights, parse_blend_mode
 from tqdm import tqdm
 
-def textured_render(render_points,viewpoint_camera, texture_camera, texture_scale, shadowmap_tol=0.05, score_mode="density"):
+# Shadow maps of texture cameras, shared between all textured renders of the process
+depth_cache = DepthCache()
+
+def textured_render(render_points,viewpoint_camera, texture_camera, texture_scale, shadowmap_tol=0.05, score_mode="density", shadow_map_padding="zeros"):
 
     #texture_coords = geom_transform_points(render_points, texture_camera.full_proj_transform)
     points_texture_camera = geom_transform_points(render_points, texture_camera.world_view_transform)
@@ -23,13 +33,12 @@ def textured_render(render_points,viewpoint_camera, texture_camera, texture_scal
 
     _,tex_h, tex_w = texture_camera.original_image.shape
 
-    texture_camera_image = (texture_camera.image_scales[texture_scale])
+    texture_camera_rgbd = rgbd_texture(texture_camera, texture_scale)
     # texture_camera_image = torch.sigmoid(texture_camera.learnable_image)
     # texture_camera_image = torch.nn.functional.interpolate(texture_camera_image.unsqueeze(0), texture_camera.image_scales[texture_scale].shape[1:], mode='area').squeeze()
-    texture_color = torch.nn.functional.grid_sample(texture_camera_image.unsqueeze(0), texture_coords.reshape((1,1,-1,2)),align_corners=False,padding_mode="border",mode='bicubic')
+    texture_color, texture_camera_target_depth = sample_rgbd(texture_camera_rgbd.unsqueeze(0), texture_coords.reshape((1,1,-1,2)), shadow_map_padding)
     #texture_color = texture_color.reshape((3,viewpoint_camera.image_height,viewpoint_camera.image_width))
 
-    texture_camera_target_depth = torch.nn.functional.grid_sample(texture_camera.rendered_depth_scales[texture_scale].unsqueeze(0), texture_coords.reshape((1,1,-1,2)),align_corners=False,mode='bicubic')
     #texture_camera_target_depth = texture_camera_target_depth.reshape((1,viewpoint_camera.image_height,viewpoint_camera.image_width))
 
     # not_in_shadow = (abs(texture_camera_depth - texture_camera_target_depth)<0.05).float()
@@ -54,6 +63,195 @@ def textured_render(render_points,viewpoint_camera, texture_camera, texture_scal
     # print((texture_color*not_in_shadow).sum().item())
     return texture_color, not_in_shadow, in_frame.float(), pixel_camera_score
 
+def rgbd_texture(camera, level, out=None):
+    """
+    Float32 (4,H,W) texture of camera at a pyramid level, its colour with the attached shadow
+    map as 4th channel. It is written to out when given.
+    """
+    depth = camera.rendered_depth_scales[level]
+    if out is None:
+        out = torch.empty((4,*depth.shape[1:]),dtype=torch.float32,device=depth.device)
+    out[:3].copy_(camera.image_scales[level])
+    out[3:].copy_(depth)
+    return out
+
+class TextureCameraStack:
+    """
+    Stacked view/projection tensors and textures of a list of texture cameras,
+    so that all of them can be sampled by textured_render_batched in one pass.
+    texture_source(camera) may return the float32 RGBD texture of a camera instead of
+    rgbd_texture, e.g. from a cache.
+    """
+    def __init__(self, texture_cameras, texture_scale=0, shadow_map_padding="zeros", texture_source=None):
+        self.cameras = texture_cameras
+        self.texture_scale = texture_scale
+        self.shadow_map_padding = shadow_map_padding
+
+        self.world_view_transforms = torch.stack([cam.world_view_transform for cam in texture_cameras])
+        self.proj_mats = torch.stack([cam.proj_mat for cam in texture_cameras]).to(self.world_view_transforms)
+        self.camera_centers = torch.stack([cam.camera_center for cam in texture_cameras])
+        self.image_sizes = torch.tensor(
+            [[cam.image_width, cam.image_height] for cam in texture_cameras],
+            dtype=self.world_view_transforms.dtype,
+            device=self.world_view_transforms.device
+        )
+
+        # Colour and shadow map of each camera, copied into one float32 RGBD texture per batch.
+        # Colours and shadow maps may be stored in half precision, only one batch is upcast at a time.
+        images = [cam.image_scales[texture_scale] for cam in texture_cameras]
+        same_shape = all(image.shape == images[0].shape for image in images)
+        if texture_source is not None:
+            textures = [texture_source(cam) for cam in texture_cameras]
+            self.textures = torch.stack(textures) if same_shape else textures
+        # Cameras of different resolution can not share a single grid_sample call
+        elif same_shape:
+            depth = texture_cameras[0].rendered_depth_scales[texture_scale]
+            self.textures = torch.empty((len(images),4,*depth.shape[1:]),dtype=torch.float32,device=depth.device)
+            for cam, texture in zip(texture_cameras, self.textures):
+                rgbd_texture(cam, texture_scale, texture)
+        else:
+            self.textures = [rgbd_texture(cam, texture_scale) for cam in texture_cameras]
+
+    def __len__(self):
+        return len(self.cameras)
+
+class TextureStackBatches:
+    """
+    Re-iterable sequence of TextureCameraStacks of batch_size cameras each. Stacks are built on
+    demand, so only one batch is held at a time, unless keep=True, in which case they are built
+    on the first pass and reused by later ones.
+    """
+    def __init__(self, texture_cameras, texture_scale=0, batch_size=16, keep=False, shadow_map_padding="zeros", texture_source=None):
+        self.cameras = texture_cameras
+        self.texture_scale = texture_scale
+        self.shadow_map_padding = shadow_map_padding
+        self.texture_source = texture_source
+        self.batch_size = batch_size
+        self.keep = keep
+        self.stacks = None
+
+    def __len__(self):
+        return len(self.cameras)
+
+    def __iter__(self):
+        if self.stacks is not None:
+            return iter(self.stacks)
+        if self.keep:
+            self.stacks = list(self.build())
+            return iter(self.stacks)
+        return self.build()
+
+    def build(self):
+        for i in range(0,len(self.cameras),self.batch_size):
+            yield TextureCameraStack(self.cameras[i:i+self.batch_size], self.texture_scale, self.shadow_map_padding, self.texture_source)
+
+def _grid_sample_stack(textures, grid, **kwargs):
+    if torch.is_tensor(textures):
+        return torch.nn.functional.grid_sample(textures, grid, **kwargs)
+    return torch.cat([
+        torch.nn.functional.grid_sample(texture.unsqueeze(0), grid[i:i+1], **kwargs)
+        for i, texture in enumerate(textures)
+    ])
+
+def _texture_sizes(textures, grid):
+    if torch.is_tensor(textures):
+        sizes = [textures.shape[:1:-1]]
+    else:
+        sizes = [texture.shape[:0:-1] for texture in textures]
+    return torch.tensor(sizes, dtype=grid.dtype, device=grid.device).reshape((-1,1,1,2))
+
+def _bicubic_inside_weight(grid, sizes, A=-0.75):
+    """
+    Total weight of the bicubic taps of grid_sample (align_corners=False) that fall inside
+    textures of the given (W,H) sizes, 1 in the interior and 0 far outside.
+    """
+    x = ((grid+1)*sizes-1)/2
+    x0 = torch.floor(x)
+    t = x-x0
+    def near(d):
+        return ((A+2)*d - (A+3))*d*d + 1
+    def far(d):
+        return ((A*d - 5*A)*d + 8*A)*d - 4*A
+    weight = 0
+    for offset, tap_weight in ((-1, far(t+1)), (0, near(t)), (1, near(1-t)), (2, far(2-t))):
+        index = x0+offset
+        weight = weight + tap_weight*((index >= 0) & (index < sizes))
+    return weight.prod(dim=-1)
+
+def sample_rgbd(textures, grid, shadow_map_padding="zeros"):
+    """
+    Bicubic samples of RGBD textures, (K,4,H,W) or a list of (4,H,W), at grid, fetched with a
+    single border padded grid_sample. Colour keeps the border padding, the shadow map is padded
+    with shadow_map_padding: "border", or "zeros", which is emulated by scaling depths with the
+    weight of the bicubic taps inside the texture, exact where the shadow map is constant across
+    the border. Returns the colours (K,3,...) and depths (K,1,...).
+    """
+    if shadow_map_padding not in ("zeros", "border"):
+        raise ValueError(f"Unknown shadow map padding {shadow_map_padding}, expected zeros or border")
+    texture_rgbd = _grid_sample_stack(textures, grid, padding_mode="border", align_corners=False, mode='bicubic')
+    texture_color, texture_depth = texture_rgbd[:,:3], texture_rgbd[:,3:]
+    if shadow_map_padding == "zeros":
+        inside_weight = _bicubic_inside_weight(grid, _texture_sizes(textures, grid))
+        texture_depth = texture_depth * inside_weight.unsqueeze(1)
+    return texture_color, texture_depth
+
+def texture_shading(texture_camera_depth, target_depth, texture_coords, camera_centers, render_points, view_center, distance_score, shadowmap_tol):
+    """
+    Elementwise part of textured_render_batched: soft shadow test, in-frame test and camera
+    scores. It has no Python branches, distance_score is a bool tensor selecting the "distance"
+    score mode, so that torch.compile can fuse it into a few kernels.
+    """
+    shadowmap_diff = texture_camera_depth - target_depth
+    not_in_shadow = torch.exp(-shadowmap_diff**2/shadowmap_tol**2)
+
+    in_frame = ((texture_coords<1) & (texture_coords>-1)).all(dim=2)
+
+    tex_vec = camera_centers.unsqueeze(1) - render_points.unsqueeze(0)
+    view_vec = view_center - render_points
+
+    eps = 1e-4
+
+    # cos(tex_vec, view_vec) / |tex_vec|, with a single norm of tex_vec
+    tex_norm = tex_vec.norm(dim=2)
+    view_dir = view_vec / (view_vec.norm(dim=1).unsqueeze(1)+eps)
+    density_score = (tex_vec * view_dir.unsqueeze(0)).sum(dim=2) / (tex_norm+eps)**2
+
+    camera_dist = torch.norm(camera_centers-view_center, dim=1)
+    distance_score_value = density_score*0+1/(camera_dist+0.05).unsqueeze(1)
+    pixel_camera_score = torch.where(distance_score, distance_score_value, density_score)
+
+    return not_in_shadow, in_frame.float(), pixel_camera_score
+
+def textured_render_batched(render_points, viewpoint_camera, texture_stack, shadowmap_tol=0.05, score_mode="density"):
+    """
+    Vectorized version of textured_render over all K cameras of a TextureCameraStack.
+    Returns colors (K,3,N), not_in_shadow (K,N), in_frame (K,N) and scores (K,N).
+    """
+    ones = torch.ones_like(render_points[:,:1])
+    points_hom = torch.cat([render_points, ones], dim=1)
+    points_texture_camera = torch.matmul(points_hom.unsqueeze(0), texture_stack.world_view_transforms)
+    points_texture_camera = points_texture_camera[...,:3] / (points_texture_camera[...,3:] + 0.0000001)
+    texture_camera_depth = points_texture_camera[...,2]
+
+    texture_coords = torch.matmul(points_texture_camera, texture_stack.proj_mats.transpose(1,2))
+    texture_coords = texture_coords[...,:2] / (texture_coords[...,2:] + 1e-9)
+
+    half_size = (texture_stack.image_sizes/2).unsqueeze(1)
+    texture_coords = (texture_coords+0.5-half_size)/half_size
+
+    grid = texture_coords.unsqueeze(1)
+    texture_color, texture_camera_target_depth = sample_rgbd(texture_stack.textures, grid, texture_stack.shadow_map_padding)
+    texture_color = texture_color[:,:,0]
+    texture_camera_target_depth = texture_camera_target_depth[:,0,0]
+
+    distance_score = torch.tensor(score_mode=="distance", device=render_points.device)
+    not_in_shadow, in_frame, pixel_camera_score = kernel(texture_shading)(
+        texture_camera_depth, texture_camera_target_depth, texture_coords, texture_stack.camera_centers,
+        render_points, viewpoint_camera.camera_center, distance_score, shadowmap_tol
+    )
+
+    return texture_color, not_in_shadow, in_frame, pixel_camera_score
+
 import torch
 import math
 
@@ -68,19 +266,36 @@ def gaussian_kernel_1d(sigma: float, num_sigmas: float = 3.) -> torch.Tensor:
 
 
 
-def blur(img,kernel_radius=2):
+# Separable blur kernels, keyed by (radius, sigma, channels, device, dtype)
+blur_kernels = {}
+
+# Blurs with a larger radius are computed on a downsampled image
+MAX_BLUR_RADIUS = 16
+
+def get_blur_kernels(kernel_radius, sigma, channels, device, dtype=torch.float):
+    key = (kernel_radius, sigma, channels, device, dtype)
+    if key not in blur_kernels:
+        support = torch.arange(-kernel_radius, kernel_radius + 1, dtype=torch.float)
+        kernel = torch.distributions.Normal(loc=0, scale=sigma).log_prob(support).exp_()
+        kernel = torch.maximum(torch.ones_like(kernel)*1e-6, kernel)
+        kernel = kernel.to(device=device, dtype=dtype)
+        horizontal_kernel = kernel.reshape((1,1,1,-1)).repeat(channels,1,1,1)
+        vertical_kernel = kernel.reshape((1,1,-1,1)).repeat(channels,1,1,1)
+        blur_kernels[key] = (horizontal_kernel, vertical_kernel)
+    return blur_kernels[key]
+
+def blur(img,kernel_radius=2,sigma=1.0):
+    if kernel_radius > MAX_BLUR_RADIUS:
+        factor = math.ceil(kernel_radius/MAX_BLUR_RADIUS)
+        small = torch.nn.functional.avg_pool2d(img.unsqueeze(0),factor,ceil_mode=True)[0]
+        small = blur(small,math.ceil(kernel_radius/factor),sigma/factor)
+        return torch.nn.functional.interpolate(small.unsqueeze(0),img.shape[-2:],mode="bilinear",align_corners=False)[0]
+
     channels = img.shape[-3]
-    vertical_kernel = torch.zeros((channels,channels,1,kernel_radius*2+1)).float()
-    for i in range(channels):
-        vertical_kernel[i,i,0,:] = gaussian_kernel_1d(1,kernel_radius)
-    vertical_kernel = vertical_kernel.cuda()
-    horizontal_kernel = torch.zeros((channels,channels,kernel_radius*2+1,1)).float()
-    for i in range(channels):
-        horizontal_kernel[i,i,:,0] = gaussian_kernel_1d(1,kernel_radius)
-    horizontal_kernel = horizontal_kernel.cuda()
-
-    img2 = torch.nn.functional.conv2d(img.unsqueeze(0),vertical_kernel[:channels,:channels],padding='same')
-    img3 = torch.nn.functional.conv2d(img2,horizontal_kernel[:channels,:channels],padding='same')
+    horizontal_kernel, vertical_kernel = get_blur_kernels(kernel_radius, sigma, channels, img.device, img.dtype)
+
+    img2 = torch.nn.functional.conv2d(img.unsqueeze(0),horizontal_kernel,padding='same',groups=channels)
+    img3 = torch.nn.functional.conv2d(img2,vertical_kernel,padding='same',groups=channels)
     return img3[0]
 
 def blur_inpaint(render_textured,render_textured_mask,kernel_radius):
@@ -91,34 +306,408 @@ def blur_inpaint(render_textured,render_textured_mask,kernel_radius):
     render_textured = render_textured*render_textured_mask + (1-render_textured_mask) * extra * (extra_mask>eps)
     render_textured_mask = 1-(1-render_textured_mask) *  (1-(extra_mask>eps).float())
     return render_textured, render_textured_mask
-    
-def get_top_texture_cameras(viewpoint_camera, render_args, texture_cameras, num_texture_views,in_training):
-    visible_texture_cameras = texture_cameras[:]
-    # visible_texture_cameras = [viewpoint_camera]
-    
-    visible_texture_cameras.sort(key=(lambda cam: torch.norm(cam.camera_center-viewpoint_camera.camera_center)))
-    visible_texture_cameras = visible_texture_cameras[int(in_training):(num_texture_views)+int(in_training)]
-    #visible_texture_cameras = visible_texture_cameras[int(in_training):]
-    
-    for camera in (visible_texture_cameras):
-        #if not hasattr(camera,"rendered_depth"):
-        camera.rendered_depth = render(camera, *render_args)["render_depth"]
-        camera.rendered_depth_scales = [camera.rendered_depth]
-        for _ in range(5):
-            #print(camera.rendered_depth.shape)
-            camera.rendered_depth_scales.append(torch.nn.functional.interpolate(camera.rendered_depth_scales[-1].unsqueeze(0),scale_factor=0.5,mode="area")[0])
-            
-        camera.proj_mat = camera.get_proj_mat().cuda()
-    
+
+def push_pull_inpaint(render_textured, render_textured_mask):
+    """
+    Fills the holes of render_textured by pushing the masked image down a mip pyramid
+    and pulling the filled coarse levels back up. Runs in time linear in the pixel count.
+    """
+    eps = 1e-7
+    weight = render_textured_mask.float()
+    colors = [render_textured*weight]
+    weights = [weight]
+    while max(weights[-1].shape[-2:]) > 1:
+        colors.append(torch.nn.functional.avg_pool2d(colors[-1].unsqueeze(0),2,ceil_mode=True)[0])
+        weights.append(torch.nn.functional.avg_pool2d(weights[-1].unsqueeze(0),2,ceil_mode=True)[0])
+
+    filled = colors[-1] / torch.clip(weights[-1],eps,10000)
+    filled_mask = (weights[-1]>eps).float()
+    for color, weight in zip(reversed(colors[:-1]), reversed(weights[:-1])):
+        filled = torch.nn.functional.interpolate(filled.unsqueeze(0),weight.shape[-2:],mode="bilinear",align_corners=False)[0]
+        filled_mask = torch.nn.functional.interpolate(filled_mask.unsqueeze(0),weight.shape[-2:],mode="nearest")[0]
+        alpha = torch.clip(weight,0,1)
+        filled = color / torch.clip(weight,eps,10000) * alpha + (1-alpha) * filled
+        filled_mask = torch.maximum(filled_mask,(weight>eps).float())
+
+    render_textured = render_textured*render_textured_mask + (1-render_textured_mask) * filled * filled_mask
+    render_textured_mask = 1-(1-render_textured_mask) * (1-filled_mask)
+    return render_textured, render_textured_mask
+
+def inpaint(render_textured, render_textured_mask, inpaint_mode="push_pull"):
+    if inpaint_mode == "blur":
+        radii = [2,5,10,100]
+    elif inpaint_mode == "push_pull_blur":
+        # Keeps the look of the small blur passes around hole borders, push-pull fills the rest
+        radii = [2,5]
+    elif inpaint_mode == "push_pull":
+        radii = []
+    else:
+        raise ValueError("Unknown inpaint mode "+inpaint_mode)
+
+    for radius in radii:
+        render_textured, render_textured_mask = blur_inpaint(render_textured, render_textured_mask,radius)
+    if inpaint_mode != "blur":
+        render_textured, render_textured_mask = push_pull_inpaint(render_textured, render_textured_mask)
+    return render_textured, render_textured_mask
+
+def scatter_pixels(values, pixel_index, num_pixels):
+    """
+    Scatters values (...,M) computed for the pixels in pixel_index back to all num_pixels pixels.
+    """
+    if pixel_index is None:
+        return values
+    full = torch.zeros((*values.shape[:-1],num_pixels),dtype=values.dtype,device=values.device)
+    return full.index_copy(values.dim()-1, pixel_index, values)
+
+def opaque_pixels(render_points, render_opacity, sparse=False):
+    """
+    Opacity mask (1,1,N) of the back-projected pixels. With sparse, only the pixels with enough
+    opacity are kept: returns their points, mask and index, else the index is None.
+    """
+    opacity_mask = (render_opacity>0.1).reshape((1,1,-1)).float()
+    if not sparse:
+        return render_points, opacity_mask, None
+    # Only pixels with enough opacity are sampled, the rest end up untextured
+    pixel_index = torch.nonzero(opacity_mask[0,0])[:,0]
+    return render_points[pixel_index], opacity_mask[:,:,pixel_index], pixel_index
+
+def blend_texture_stack(blend, render_points, opacity_mask, viewpoint_camera, texture_stack, score_mode, ablations):
+    """
+    Samples one TextureCameraStack at render_points and folds it into the StreamingBlend blend.
+    Returns the per-camera colours (K,3,N) and masks (K,1,N).
+    """
+    curr_texture_colors, curr_texture_mask,curr_texture_in_frame,pixel_camera_score = textured_render_batched(render_points,viewpoint_camera, texture_stack,score_mode=score_mode)
+
+    curr_texture_mask = curr_texture_mask.unsqueeze(1)
+    curr_texture_in_frame = curr_texture_in_frame.unsqueeze(1) * opacity_mask
+    pixel_camera_score = pixel_camera_score.unsqueeze(1)
+
+    if "score" in ablations:
+        pixel_camera_score = pixel_camera_score*0+1
+
+    curr_texture_mask = curr_texture_mask * curr_texture_in_frame
+
+    if "visibility" not in ablations:
+        pixel_camera_score = pixel_camera_score * curr_texture_mask
+    else:
+        pixel_camera_score = pixel_camera_score * curr_texture_in_frame
+
+    blend.update(curr_texture_colors, curr_texture_mask, curr_texture_in_frame, pixel_camera_score)
+    return curr_texture_colors, curr_texture_mask
+
+def blend_result(blend, pixel_index, num_pixels, track_in_frame=True):
+    """
+    Blended colours (3,N), mask (1,N) and in-frame mask (1,N) of blend, scattered back to all
+    num_pixels pixels.
+    """
+    render_textured, render_textured_mask = blend.result()
+    render_textured = scatter_pixels(render_textured, pixel_index, num_pixels)
+    render_textured_mask = scatter_pixels(render_textured_mask, pixel_index, num_pixels)
+    render_textured_in_frame = scatter_pixels(blend.in_frame(), pixel_index, num_pixels) if track_in_frame else None
+    return render_textured, render_textured_mask, render_textured_in_frame
+
+def texture_pixels(render_points, render_opacity, viewpoint_camera, texture_stacks, blend_mode, score_mode, ablations, track_in_frame=True, return_stacks=False, sparse=False):
+    """
+    Samples and blends the TextureCameraStacks in texture_stacks for a flat list of back-projected pixels.
+    Returns the blended colours (3,N), mask (1,N), in-frame mask (1,N) and, with
+    return_stacks, the per-camera colours (K,3,N) and masks (K,1,N), in float32 whatever the
+    storage dtype of the textures, since training losses are computed on them.
+    """
+    num_pixels = render_points.shape[0]
+    render_points, opacity_mask, pixel_index = opaque_pixels(render_points, render_opacity, sparse)
+    blend = StreamingBlend(blend_mode, render_points.shape[0], render_points.device, track_in_frame=track_in_frame)
+
+    texture_colors = []
+    texture_masks = []
+    for texture_stack in texture_stacks:
+        curr_texture_colors, curr_texture_mask = blend_texture_stack(blend, render_points, opacity_mask, viewpoint_camera, texture_stack, score_mode, ablations)
+        if return_stacks:
+            texture_colors.append(scatter_pixels(curr_texture_colors, pixel_index, num_pixels))
+            texture_masks.append(scatter_pixels(curr_texture_mask, pixel_index, num_pixels))
+
+    render_textured, render_textured_mask, render_textured_in_frame = blend_result(blend, pixel_index, num_pixels, track_in_frame)
+    if return_stacks:
+        return render_textured, render_textured_mask, render_textured_in_frame, torch.cat(texture_colors), torch.cat(texture_masks)
+    return render_textured, render_textured_mask, render_textured_in_frame, None, None
+
+def texture_tiles(render_depth, render_opacity, viewpoint_camera, texture_stacks, blend_mode, score_mode, ablations, tile_size=512, track_in_frame=True, sparse=False):
+    """
+    Like texture_pixels, one screen tile at a time, stitching the tiles into full images.
+    Every tile keeps its own StreamingBlend, and each texture stack is folded into all tiles
+    before the next one is built, so only one stack is held at a time.
+    """
+    _, h, w = render_depth.shape
+    reserve_camera_rays(math.ceil(h/tile_size)*math.ceil(w/tile_size))
+
+    tiles = []
+    for y0 in range(0,h,tile_size):
+        for x0 in range(0,w,tile_size):
+            tile_depth = render_depth[:,y0:y0+tile_size,x0:x0+tile_size]
+            tile_opacity = render_opacity[:,y0:y0+tile_size,x0:x0+tile_size]
+            tile_points = depth_image_to_point_cloud(tile_depth, viewpoint_camera, pixel_offset=(x0,y0), image_size=(h,w))
+            num_pixels = tile_points.shape[0]
+            tile_points, opacity_mask, pixel_index = opaque_pixels(tile_points, tile_opacity, sparse)
+            blend = StreamingBlend(blend_mode, tile_points.shape[0], tile_points.device, track_in_frame=track_in_frame)
+            tiles.append((y0, x0, tile_depth.shape[1:], num_pixels, tile_points, opacity_mask, pixel_index, blend))
+
+    for texture_stack in texture_stacks:
+        for _, _, _, _, tile_points, opacity_mask, _, blend in tiles:
+            blend_texture_stack(blend, tile_points, opacity_mask, viewpoint_camera, texture_stack, score_mode, ablations)
+
+    render_textured = torch.zeros((3,h,w),device=render_depth.device)
+    render_textured_mask = torch.zeros((1,h,w),device=render_depth.device)
+    render_textured_in_frame = torch.zeros((1,h,w),device=render_depth.device) if track_in_frame else None
+    for y0, x0, tile_shape, num_pixels, _, _, pixel_index, blend in tiles:
+        tile_textured, tile_mask, tile_in_frame = blend_result(blend, pixel_index, num_pixels, track_in_frame)
+        render_textured[:,y0:y0+tile_size,x0:x0+tile_size] = tile_textured.reshape((3,*tile_shape))
+        render_textured_mask[:,y0:y0+tile_size,x0:x0+tile_size] = tile_mask.reshape((1,*tile_shape))
+        if track_in_frame:
+            render_textured_in_frame[:,y0:y0+tile_size,x0:x0+tile_size] = tile_in_frame.reshape((1,*tile_shape))
+
+    return render_textured, render_textured_mask, render_textured_in_frame
+
+def get_top_texture_cameras(viewpoint_camera, render_args, texture_cameras, num_texture_views,in_training,frustum_culling=False):
+    if not isinstance(texture_cameras, CameraIndex):
+        texture_cameras = CameraIndex(texture_cameras)
+    visible_texture_cameras = texture_cameras.select_cameras(viewpoint_camera, num_texture_views, skip_self=in_training, frustum_culling=frustum_culling)
+    attach_shadow_maps(visible_texture_cameras, render_args)
     return visible_texture_cameras
 
-def textured_render_multicam(viewpoint_camera, texture_cameras, pc : GaussianModel, pipe, bg_color : torch.Tensor,in_training=False, texture_scale=0, blend_mode="scores2",num_texture_views=100,ablations=[]):
-    render_pkg_view = render(viewpoint_camera, pc, pipe, bg_color)
+def get_visible_texture_cameras(viewpoint_camera, render_args, visible_gaussians, num_texture_views, in_training):
+    """
+    Like get_top_texture_cameras, but picks the cameras of pc.visibility_index that see most
+    of the Gaussians visible_gaussians visible in viewpoint_camera.
+    """
+    pc = render_args[0]
+    exclude = viewpoint_camera if in_training else None
+    visible_texture_cameras = pc.visibility_index.select_cameras(visible_gaussians, num_texture_views, exclude)
+    attach_shadow_maps(visible_texture_cameras, render_args)
+    return visible_texture_cameras
+
+def shadow_map_depths(pc, pipe):
+    return lambda cameras: (render_pkg["render_depth"] for render_pkg in render_depths(cameras, pc, pipe))
+
+def attach_shadow_maps(cameras, render_args):
+    pc, pipe, _ = render_args
+    depth_cache.memory_budget_mb = pipe.depth_cache_mb
+    cameras = list(cameras)
+    for camera, depth_scales in zip(cameras, depth_cache.get_many(cameras, pc, shadow_map_depths(pc, pipe))):
+        camera.rendered_depth_scales = depth_scales
+        camera.rendered_depth = camera.rendered_depth_scales[0]
+        camera.proj_mat = camera.get_proj_mat().cuda()
+
+def build_visibility_index(pc, cameras, pipe, bg_color, depth_tol=0.05):
+    """
+    Builds pc.visibility_index over cameras, with shadow maps from the depth cache.
+    """
+    depth_cache.memory_budget_mb = pipe.depth_cache_mb
+    with torch.no_grad():
+        pc.visibility_index = VisibilityIndex.build(
+            pc, cameras,
+            lambda camera: depth_cache.get_many([camera], pc, shadow_map_depths(pc, pipe))[0][0],
+            depth_tol
+        )
+    return pc.visibility_index
+
+def texture_memory_mb(camera):
+    """
+    Memory of the colour pyramid of camera and of its shadow map pyramid once attached, which
+    is stored in the same dtype.
+    """
+    return sum(level.numel()//3*4*level.element_size() for level in camera.image_scales) / 1024**2
+
+def select_covering_cameras(pc, cameras, pipe, bg_color, target_coverage=0.99, memory_budget_mb=None, depth_tol=0.05):
+    """
+    Smallest subset of cameras, found greedily, whose shadow maps see target_coverage of the
+    Gaussians seen by any of them, with texture pyramids fitting in memory_budget_mb.
+    Returns the cameras and a summary of the selection.
+    """
+    cameras = list(cameras)
+    index = build_visibility_index(pc, cameras, pipe, bg_color, depth_tol)
+    costs = torch.tensor([texture_memory_mb(camera) for camera in cameras])
+    selection, coverage = index.greedy_cover(target_coverage, costs, memory_budget_mb)
+    summary = {
+        "target_coverage": target_coverage,
+        "memory_budget_mb": memory_budget_mb,
+        "coverage": coverage,
+        "memory_mb": costs[selection].sum().item(),
+        "num_cameras": len(cameras),
+        "cameras": [cameras[i].image_name for i in selection],
+    }
+    return [cameras[i] for i in selection], summary
 
-    render_textured = torch.zeros_like(viewpoint_camera.original_image)
-    render_textured_mask  = torch.zeros((render_textured.shape[0],render_textured.shape[1],1)).cuda().bool()
+def save_camera_selection(path, summary):
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=True)
 
-    render_points = depth_image_to_point_cloud(render_pkg_view["render_depth"], viewpoint_camera)
+def load_camera_selection(path, cameras):
+    """
+    The cameras named in a selection written by save_camera_selection, in its order.
+    """
+    with open(path) as f:
+        names = json.load(f)["cameras"]
+    by_name = {camera.image_name: camera for camera in cameras}
+    missing = [name for name in names if name not in by_name]
+    if len(missing) > 0:
+        raise ValueError(f"{path} selects cameras that are not in the scene: {missing[:5]}")
+    return [by_name[name] for name in names]
+
+class CameraPathState:
+    """
+    Texture camera selection and textures (images and shadow maps) carried between consecutive
+    frames of a camera path. The selection is only redone once the view has moved more than
+    translation_threshold (scene units) or rotated more than rotation_threshold (radians) since
+    it was last made. The float32 RGBD texture of each sampled camera is cached, in LRU order and
+    within memory_budget_mb, so a new selection only builds the textures of the cameras it adds.
+    The cache is cleared when the texture scale or the model changed.
+    """
+    def __init__(self, translation_threshold=0.05, rotation_threshold=0.05, memory_budget_mb=2048):
+        self.translation_threshold = translation_threshold
+        self.rotation_threshold = rotation_threshold
+        self.memory_budget_mb = memory_budget_mb
+        self.camera_center = None
+        self.rotation = None
+        self.model_key = None
+        self.texture_scale = None
+        self.visible_texture_cameras = None
+        self.texture_stacks = None
+        self.textures = OrderedDict()
+        self.texture_memory = 0
+        self.selections = 0
+        self.texture_builds = 0
+
+    def needs_selection(self, viewpoint_camera, pc):
+        if self.camera_center is None or self.model_key != (id(pc), pc.version):
+            return True
+        translation = torch.norm(viewpoint_camera.camera_center - self.camera_center)
+        relative = viewpoint_camera.world_view_transform[:3,:3] @ self.rotation.T
+        rotation = torch.acos(torch.clamp((torch.trace(relative)-1)/2,-1,1))
+        return translation.item() > self.translation_threshold or rotation.item() > self.rotation_threshold
+
+    def update(self, viewpoint_camera, pc, visible_texture_cameras, sampled_texture_cameras, texture_scale, texture_batch_size, shadow_map_padding="zeros", memory_budget_mb=None):
+        """
+        Records a fresh selection made at viewpoint_camera. Cached textures of the sampled
+        cameras are kept if the model and texture scale did not change.
+        """
+        self.selections += 1
+        self.camera_center = viewpoint_camera.camera_center.clone()
+        self.rotation = viewpoint_camera.world_view_transform[:3,:3].clone()
+        self.visible_texture_cameras = visible_texture_cameras
+        if memory_budget_mb is not None:
+            self.memory_budget_mb = memory_budget_mb
+
+        model_key = (id(pc), pc.version)
+        if model_key != self.model_key or texture_scale != self.texture_scale:
+            self.textures.clear()
+            self.texture_memory = 0
+        self.model_key = model_key
+        self.texture_scale = texture_scale
+        self.texture_stacks = TextureStackBatches(sampled_texture_cameras, texture_scale, texture_batch_size, shadow_map_padding=shadow_map_padding, texture_source=self.texture)
+
+    def texture(self, camera):
+        """
+        Float32 RGBD texture of camera at the current texture scale, from the cache if possible.
+        """
+        key = DepthCache.camera_key(camera)
+        if key in self.textures:
+            self.textures.move_to_end(key)
+            return self.textures[key]
+        texture = rgbd_texture(camera, self.texture_scale)
+        self.texture_builds += 1
+        size = texture.numel() * texture.element_size()
+        if size <= self.memory_budget_mb * 1024**2:
+            self.textures[key] = texture
+            self.texture_memory += size
+            while self.texture_memory > self.memory_budget_mb * 1024**2:
+                _, evicted = self.textures.popitem(last=False)
+                self.texture_memory -= evicted.numel() * evicted.element_size()
+        return texture
+
+    def stats(self):
+        return {"selections": self.selections, "texture_builds": self.texture_builds, "cached_textures": len(self.textures)}
+
+def select_texture_cameras_coarse(render_pkg_view, viewpoint_camera, visible_texture_cameras, blend_mode, score_mode="density", coverage_saturation=0.995, shadow_map_padding="zeros", dropped_weight=0.05):
+    """
+    Cheap pre-pass at the coarsest pyramid level. For every covered coarse pixel, keeps the
+    cameras with the largest blend weights until at most dropped_weight of its total weight is
+    left out, then adds cameras by marginal coverage until the textured mask saturates. The kept
+    cameras are returned in their original order, all of them if none covers the view.
+    """
+    with torch.no_grad():
+        level = len(visible_texture_cameras[0].rendered_depth_scales)-1
+        factor = 2**level
+        # Coarse pixels are covered if any of their pixels is, at the depth of the closest one, so
+        # that thin geometry is kept and silhouettes are not pulled towards the camera
+        opacity = render_pkg_view["render_opacity"]
+        depth = torch.where(opacity>0.1, render_pkg_view["render_depth"], torch.full_like(opacity, math.inf))
+        coarse_opacity = torch.nn.functional.max_pool2d(opacity.unsqueeze(0), factor)[0]
+        coarse_depth = -torch.nn.functional.max_pool2d(-depth.unsqueeze(0), factor)[0]
+        coarse_depth = torch.where(torch.isinf(coarse_depth), torch.zeros_like(coarse_depth), coarse_depth)
+        render_points = depth_image_to_point_cloud(coarse_depth, viewpoint_camera)
+
+        texture_stack = TextureCameraStack(visible_texture_cameras, level, shadow_map_padding)
+        _, masks, in_frame, scores = textured_render_batched(render_points, viewpoint_camera, texture_stack, score_mode=score_mode)
+        coverage = masks * in_frame * (coarse_opacity>0.1).reshape((1,-1)).float()
+
+        # Weights as texture_pixels blends the cameras, uncovered pixels are left untextured
+        weights = blend_weights(blend_mode, coverage.unsqueeze(1), (scores*coverage).unsqueeze(1))[:,0]
+        weights = weights[:,coverage.amax(dim=0)>0]
+        sorted_weights, order = weights.sort(dim=0, descending=True)
+        cumulative = sorted_weights.cumsum(dim=0)
+        needed = cumulative - sorted_weights < (1-dropped_weight) * cumulative[-1:]
+        keep = torch.zeros_like(needed).scatter_(0, order, needed).any(dim=1)
+        covered = (coverage*keep.unsqueeze(1)).amax(dim=0)
+        target = coverage_saturation * coverage.amax(dim=0).sum()
+        while covered.sum() < target:
+            gain = torch.clamp(coverage-covered,min=0).sum(dim=1)
+            gain[keep] = -1
+            best = gain.argmax()
+            if gain[best] <= 0:
+                break
+            keep[best] = True
+            covered = torch.maximum(covered,coverage[best])
+
+    if not keep.any():
+        return list(visible_texture_cameras)
+    return [camera for camera, kept in zip(visible_texture_cameras, keep.tolist()) if kept]
+
+def textured_render_multicam(viewpoint_camera, texture_cameras, pc : GaussianModel, pipe, bg_color : torch.Tensor,in_training=False, texture_scale=0, blend_mode="scores2",num_texture_views=100,ablations=[],texture_batch_size=16,inpaint_mode="push_pull",return_stacks=False,frustum_culling=False,adaptive_texture_views=False,coverage_saturation=0.995,outputs=None,sparse=False,tile_size=None,path_state=None,visibility_selection=False):
+    """
+    Renders viewpoint_camera with colours sampled from the closest texture cameras.
+
+    Texture cameras are sampled texture_batch_size at a time and folded into a
+    StreamingBlend, so peak memory does not grow with num_texture_views. The full
+    texture_colors and texture_masks stacks are only materialised, and only present in the
+    returned RenderPackage, with return_stacks=True or when they are listed in outputs.
+
+    The returned RenderPackage computes secondary fields on first access. If outputs is
+    given, fields that are not listed are not available at all, and the data they would
+    need is freed right away.
+
+    With sparse=True, only pixels with render_opacity>0.1 are projected, sampled and blended,
+    and the results are scattered back into the full image.
+
+    With tile_size set, back-projection, sampling and blending run one tile_size x tile_size
+    screen tile at a time, which bounds memory for very large output resolutions. Inpainting
+    runs on the stitched image, so tiles leave no seams.
+
+    Consecutive frames of a camera path can pass the same CameraPathState as path_state, to reuse
+    the texture camera selection of earlier frames while the view stays close, and the textures
+    of the cameras that stay selected.
+
+    With visibility_selection, texture cameras are picked by how many of the Gaussians visible in
+    the view they see according to pc.visibility_index, instead of by distance.
+    """
+    def wants(key):
+        return outputs is None or key in outputs
+
+    return_stacks = return_stacks or (outputs is not None and ("texture_colors" in outputs or "texture_masks" in outputs))
+
+    render_pkg_view = render(viewpoint_camera, pc, pipe, bg_color)
+
+    render_points = None
+    if tile_size is None:
+        render_points = depth_image_to_point_cloud(render_pkg_view["render_depth"], viewpoint_camera)
     # render_points = depth_image_to_point_cloud(viewpoint_camera.depth.cuda()-4e-2, viewpoint_camera)
 
     # viewpoint_frustrum_points = camera_frustrum_points(viewpoint_camera)
@@ -135,77 +724,54 @@ def textured_render_multicam(viewpoint_camera, texture_cameras, pc : GaussianMod
             
     #     #print("Vis cams:",len(visible_texture_cameras))
     
-    visible_texture_cameras = get_top_texture_cameras(viewpoint_camera,(pc,pipe,bg_color),texture_cameras,num_texture_views,in_training)
-    
-    texture_colors = []
-    texture_masks = []
-    texture_in_frame = []
-    texture_scores = []
+    blend_mode, score_mode = parse_blend_mode(blend_mode)
 
-    score_mode="density"
-    if blend_mode[-1:]=="2":
-        score_mode="distance"
-    blend_mode = blend_mode[:-1]
+    # Cameras that get_top_texture_cameras attached shadow maps to, released at the end
+    attached_texture_cameras = []
+    if path_state is None or path_state.needs_selection(viewpoint_camera, pc):
+        if visibility_selection and pc.visibility_index is not None:
+            visible_texture_cameras = get_visible_texture_cameras(viewpoint_camera,(pc,pipe,bg_color),render_pkg_view["visibility_filter"],num_texture_views,in_training)
+        else:
+            visible_texture_cameras = get_top_texture_cameras(viewpoint_camera,(pc,pipe,bg_color),texture_cameras,num_texture_views,in_training,frustum_culling)
+        attached_texture_cameras = visible_texture_cameras
 
-    for i,texture_camera in enumerate(visible_texture_cameras):
-        #print(texture_camera.colmap_id, exclude_texture_idx)
-        curr_texture_colors, curr_texture_mask,curr_texture_in_frame,pixel_camera_score = textured_render(render_points,viewpoint_camera, texture_camera, texture_scale=texture_scale,score_mode=score_mode)
+        sampled_texture_cameras = visible_texture_cameras
+        if adaptive_texture_views and len(visible_texture_cameras) > 1:
+            sampled_texture_cameras = select_texture_cameras_coarse(render_pkg_view, viewpoint_camera, visible_texture_cameras, blend_mode, score_mode, coverage_saturation, pipe.shadow_map_padding)
 
-        texture_colors.append(curr_texture_colors.reshape(3,viewpoint_camera.image_height,viewpoint_camera.image_width))
-        texture_masks.append(curr_texture_mask.reshape(1,viewpoint_camera.image_height,viewpoint_camera.image_width))
-        texture_in_frame.append(curr_texture_in_frame.reshape(1,viewpoint_camera.image_height,viewpoint_camera.image_width))
-        texture_scores.append(pixel_camera_score.reshape(1,viewpoint_camera.image_height,viewpoint_camera.image_width))
+        if path_state is not None:
+            path_state.update(viewpoint_camera, pc, visible_texture_cameras, sampled_texture_cameras, texture_scale, texture_batch_size, pipe.shadow_map_padding, pipe.depth_cache_mb)
 
-    
-    texture_colors = torch.stack(texture_colors)
-    texture_in_frame = torch.stack(texture_in_frame)
-    texture_masks = torch.stack(texture_masks)
-    texture_scores = torch.stack(texture_scores)
-    texture_in_frame *= (render_pkg_view["render_opacity"]>0.1).unsqueeze(0)
-    
-    if "score" in ablations:
-        texture_scores = texture_scores*0+1
-        
-    texture_masks *= texture_in_frame
-    
-    if "visibility" not in ablations:
-        texture_scores *= texture_masks
-    else:
-        texture_scores *= texture_in_frame
-    
-    if blend_mode == "alpha":
-        w = torch.zeros_like(texture_masks)
-        T = torch.ones_like(texture_masks[0])
-        render_textured_mask = 1 - torch.prod(1-texture_masks,dim=0)
-        
-        for i in range(len(visible_texture_cameras)):
-            w[i] = texture_masks[i] * T
-            T = T*(1-texture_masks[i])
-            
-        render_textured = (texture_colors*w).sum(dim=0)# + (1-render_textured_mask)*texture_colors[0]
-        
+    if path_state is not None:
+        visible_texture_cameras = path_state.visible_texture_cameras
+        texture_stacks = path_state.texture_stacks
     else:
-        eps = 1e-10
-        #texture_scores = torch.exp((texture_scores-0.5*(1-texture_masks)+0.5)*100)
-        
-        texture_scores = texture_scores#-1*(1-texture_masks)
-        if blend_mode=="scores_softmax":
-            texture_scores = texture_scores-texture_scores.min()
-            texture_scores = torch.exp(texture_scores*4)
-        else:
-            texture_scores = (texture_scores==(texture_scores.amax(dim=0).unsqueeze(0)))
-            
-        render_textured = (texture_colors * texture_scores).sum(dim=0) / (texture_scores.sum(dim=0)+eps)
-        #texture_scores.sum(dim=0)<eps
-        #render_textured = render_textured * (texture_scores.sum(dim=0)>eps) + (texture_scores.sum(dim=0)<eps)
-        
-        render_textured_mask = torch.minimum(torch.sum(texture_masks,dim=0),torch.ones_like(torch.sum(texture_masks,dim=0)))
-        
-        #     render_textured += curr_texture_colors * (~render_textured_mask)
-        #     render_textured_mask = render_textured_mask | curr_texture_mask
+        texture_stacks = TextureStackBatches(sampled_texture_cameras, texture_scale, texture_batch_size, shadow_map_padding=pipe.shadow_map_padding)
 
-        # render_textured = render_textured/torch.clip(render_textured_mask,0.1,10000)
+    image_shape = (viewpoint_camera.image_height,viewpoint_camera.image_width)
+    texture_args = (viewpoint_camera, texture_stacks, blend_mode, score_mode, ablations)
 
+    if tile_size is None:
+        render_textured, render_textured_mask, render_textured_in_frame, texture_colors, texture_masks = texture_pixels(
+            render_points, render_pkg_view["render_opacity"], *texture_args,
+            track_in_frame=wants("render_textured_in_frame"), return_stacks=return_stacks, sparse=sparse
+        )
+        render_textured = render_textured.reshape((3,*image_shape))
+        render_textured_mask = render_textured_mask.reshape((1,*image_shape))
+        if render_textured_in_frame is not None:
+            render_textured_in_frame = render_textured_in_frame.reshape((1,*image_shape))
+        if return_stacks:
+            texture_colors = texture_colors.reshape((-1,3,*image_shape))
+            texture_masks = texture_masks.reshape((-1,1,*image_shape))
+    else:
+        if return_stacks:
+            raise ValueError("Texture stacks can not be returned from a tiled render")
+        render_textured, render_textured_mask, render_textured_in_frame = texture_tiles(
+            render_pkg_view["render_depth"], render_pkg_view["render_opacity"], *texture_args,
+            tile_size=tile_size, track_in_frame=wants("render_textured_in_frame"), sparse=sparse
+        )
+        texture_colors = None
+        texture_masks = None
 
     #torch.nn.functional.conv2d(render_textured, )
     
@@ -217,46 +783,48 @@ def textured_render_multicam(viewpoint_camera, texture_cameras, pc : GaussianMod
 
     #render_textured = render_textured*render_textured_mask + (1-render_textured_mask)*render_pkg_view["render"]#*torch.tensor([1.0,0.0,0.0]).cuda().reshape((3,1,1))
 
-    before_blend = render_textured.clone()
-    before_blend_mask = render_textured_mask.clone()
-    before_blend *= (before_blend_mask>0.5)
+    # Inpainting is out of place, so these stay valid without a copy
+    before_blend = render_textured
+    before_blend_mask = render_textured_mask
     if not in_training:
         render_textured_mask = (render_textured_mask>0.5).float()
         render_textured = render_textured*render_textured_mask
-        render_textured, render_textured_mask = blur_inpaint(render_textured, render_textured_mask,2)
-        render_textured, render_textured_mask = blur_inpaint(render_textured, render_textured_mask,5)
-        render_textured, render_textured_mask = blur_inpaint(render_textured, render_textured_mask,10)
-        render_textured, render_textured_mask = blur_inpaint(render_textured, render_textured_mask,100)
+        render_textured, render_textured_mask = inpaint(render_textured, render_textured_mask, inpaint_mode)
         #print((render_textured).sum().item())
     
-    for camera in (visible_texture_cameras):
+    for camera in (attached_texture_cameras):
         del camera.rendered_depth
         del camera.rendered_depth_scales
         del camera.proj_mat
-    torch.cuda.empty_cache()
+    if pipe.depth_cache_mb <= 0:
+        torch.cuda.empty_cache()
     
-    return {
-        "before_blend": before_blend,
-        "before_blend_mask": before_blend_mask,
-        "render_textured": render_textured,
-        "render_textured_mask": render_textured_mask,
-        "render_textured_in_frame": 1-torch.prod(1-texture_in_frame.float(),dim=0),
-        "texture_colors": texture_colors,
-        "texture_masks": texture_masks, 
-        "texture_images": [cam.learnable_image for cam in visible_texture_cameras],
-        **render_pkg_view
-    }
+    render_pkg = render_pkg_view.copy()
+    render_pkg["render_textured"] = render_textured
+    render_pkg["render_textured_mask"] = render_textured_mask
+    if wants("before_blend"):
+        render_pkg.add_lazy("before_blend", lambda: before_blend*(before_blend_mask>0.5))
+    if wants("before_blend_mask"):
+        render_pkg.add_lazy("before_blend_mask", lambda: before_blend_mask)
+    if wants("render_textured_in_frame"):
+        render_pkg.add_lazy("render_textured_in_frame", lambda: render_textured_in_frame)
+    # The stacks are only sampled with return_stacks, without it the fields are left out
+    if return_stacks and wants("texture_colors"):
+        render_pkg["texture_colors"] = texture_colors
+    if return_stacks and wants("texture_masks"):
+        render_pkg["texture_masks"] = texture_masks
+    if wants("texture_images"):
+        render_pkg.add_lazy("texture_images", lambda: [cam.learnable_image for cam in visible_texture_cameras])
+    return render_pkg
 
 def prerender_depth(cameras, pc, pipe, bg_color):
+    depth_cache.memory_budget_mb = pipe.depth_cache_mb
     with torch.no_grad():
-        for camera in (cameras):
-            if not hasattr(camera,"rendered_depth"):
-                camera.rendered_depth = render(camera, pc, pipe, bg_color)["render_depth"]
-            camera.rendered_depth_scales = [camera.rendered_depth]
-            for _ in range(5):
-                #print(camera.rendered_depth.shape)
-                camera.rendered_depth_scales.append(torch.nn.functional.interpolate(camera.rendered_depth_scales[-1].unsqueeze(0),scale_factor=0.5,mode="area")[0])
-                
+        missing = [camera for camera in cameras if not hasattr(camera,"rendered_depth")]
+        for camera, depth_scales in zip(missing, depth_cache.get_many(missing, pc, shadow_map_depths(pc, pipe))):
+            camera.rendered_depth_scales = depth_scales
+            camera.rendered_depth = camera.rendered_depth_scales[0]
+        for camera in cameras:
             camera.proj_mat = camera.get_proj_mat().cuda()
 
 def get_normal(scale, q):
@@ -273,17 +841,184 @@ def get_normal(scale, q):
         2 * (x * z - r * y), 2 * (y * z + r * x), 1 - 2 * (x * x + y * y)
     ],dim=1).reshape((-1,3,3))
 
-    normals = (torch.bmm(local_normal.reshape((-1,1,3)), R)).reshape((-1,3))
+    # The local axes of a Gaussian are the columns of its rotation
+    normals = (torch.bmm(R, local_normal.reshape((-1,3,1)))).reshape((-1,3))
     return normals/normals.norm(dim=1).unsqueeze(1)
 
-def get_3d_point(pc,view_camera):
-    normals = get_normal(pc.get_scale,pc.get_rot)
-    
+def get_3d_point(pc):
+    """
+    Surface points and normals of the Gaussians: their centers, and the axis of their smallest scale.
+    """
+    return pc.get_xyz, get_normal(pc.get_scaling,pc.get_rotation)
 
-def get_uv_function(pc, view_camera, texture_camera):
-    normals = get_normal(pc.get_scale,pc.get_rot)
-    
-    
+def get_uv_function(points, texture_camera):
+    """
+    Texture coordinates of points in texture_camera, in grid_sample units, with their view
+    space depth (N,) and the Jacobian (N,2,3) of the texture coordinates w.r.t. the points.
+    """
+    rotation = texture_camera.world_view_transform[:3,:3]
+    points_camera = points @ rotation + texture_camera.world_view_transform[3,:3]
+    depth = points_camera[:,2]
+    inv_depth = 1/(depth+1e-9)
+
+    proj_mat = texture_camera.get_proj_mat().to(points)
+    fx, fy, cx, cy = proj_mat[0,0], proj_mat[1,1], proj_mat[0,2], proj_mat[1,2]
+    half_w = texture_camera.image_width/2
+    half_h = texture_camera.image_height/2
+
+    x = points_camera[:,0]*inv_depth
+    y = points_camera[:,1]*inv_depth
+    uv = torch.stack([
+        (fx*x+cx+0.5-half_w)/half_w,
+        (fy*y+cy+0.5-half_h)/half_h
+    ],dim=1)
+
+    # d(uv)/d(camera point), then chained with the world to camera rotation
+    zeros = torch.zeros_like(x)
+    jacobian_camera = torch.stack([
+        torch.stack([fx/half_w*inv_depth, zeros, -fx/half_w*x*inv_depth],dim=1),
+        torch.stack([zeros, fy/half_h*inv_depth, -fy/half_h*y*inv_depth],dim=1),
+    ],dim=1)
+    jacobian = jacobian_camera @ rotation.T
+    return uv, depth, jacobian
+
+class GaussianTextureCoords:
+    """
+    Texture lookups precomputed per Gaussian, for static models that are rendered many times.
+
+    For every Gaussian it keeps the num_cameras texture cameras that see its center best, with
+    the texture coordinates of the center, the Jacobian of the texture coordinates there, the
+    mip level matching its footprint, its soft visibility and the colour sampled at that level.
+    A view is then textured by blending these per Gaussian colours and rasterizing them once,
+    instead of back-projecting every pixel and re-projecting it into every texture camera.
+    """
+    def __init__(self, cameras, camera_ids, uv, jacobians, levels, visibility, colors, version):
+        self.cameras = cameras
+        self.camera_centers = torch.stack([cam.camera_center for cam in cameras])
+        self.camera_ids = camera_ids
+        self.uv = uv
+        self.jacobians = jacobians
+        self.levels = levels
+        self.visibility = visibility
+        self.colors = colors
+        self.version = version
+
+    @classmethod
+    def build(cls, pc, texture_cameras, render_args, num_cameras=8, shadowmap_tol=0.05):
+        texture_cameras = list(texture_cameras)
+        num_cameras = min(num_cameras, len(texture_cameras))
+        _, pipe, _ = render_args
+        with torch.no_grad():
+            points, normals = get_3d_point(pc)
+            extent = 3*pc.get_scaling.amax(dim=1)
+            num_points = points.shape[0]
+            device = points.device
+
+            quality = torch.full((num_points,num_cameras),-1.0,device=device)
+            camera_ids = torch.zeros((num_points,num_cameras),dtype=torch.long,device=device)
+            uv = torch.zeros((num_points,num_cameras,2),device=device)
+            jacobians = torch.zeros((num_points,num_cameras,2,3),device=device)
+            levels = torch.zeros((num_points,num_cameras),dtype=torch.uint8,device=device)
+            visibility = torch.zeros((num_points,num_cameras),device=device)
+            colors = torch.zeros((num_points,num_cameras,3),device=device)
+
+            for i, camera in enumerate(texture_cameras):
+                attach_shadow_maps([camera], render_args)
+                cam_uv, cam_depth, cam_jacobian = get_uv_function(points, camera)
+                cam_levels, cam_visibility, cam_colors = sample_gaussian_textures(camera, cam_uv, cam_depth, cam_jacobian, extent, shadowmap_tol, pipe.shadow_map_padding)
+
+                # Visible, in frame and not at a grazing angle
+                tex_dir = camera.camera_center - points
+                tex_dir = tex_dir/(tex_dir.norm(dim=1,keepdim=True)+1e-9)
+                cam_quality = cam_visibility * torch.abs((tex_dir*normals).sum(dim=1))
+
+                candidates = torch.cat([quality, cam_quality.unsqueeze(1)],dim=1)
+                quality, keep = torch.topk(candidates, num_cameras, dim=1)
+
+                def merge(kept, new):
+                    merged = torch.cat([kept, new.unsqueeze(1)],dim=1)
+                    index = keep.reshape((*keep.shape,*([1]*(merged.dim()-2)))).expand((-1,-1,*merged.shape[2:]))
+                    return torch.gather(merged, 1, index)
+
+                camera_ids = merge(camera_ids, torch.full_like(camera_ids[:,0], i))
+                uv = merge(uv, cam_uv)
+                jacobians = merge(jacobians, cam_jacobian)
+                levels = merge(levels, cam_levels)
+                visibility = merge(visibility, cam_visibility)
+                colors = merge(colors, cam_colors)
+
+                del camera.rendered_depth
+                del camera.rendered_depth_scales
+                del camera.proj_mat
+
+        return cls(texture_cameras, camera_ids, uv, jacobians, levels, visibility*(quality>0), colors, pc.version)
+
+    def is_current(self, pc):
+        return self.version == pc.version
+
+    def blend(self, viewpoint_camera, points, blend_mode="scores", score_mode="density"):
+        """
+        Per Gaussian colours (N,3) and masks (N,1) for viewpoint_camera.
+        """
+        tex_centers = self.camera_centers[self.camera_ids]
+        tex_vec = tex_centers - points.unsqueeze(1)
+        view_vec = viewpoint_camera.camera_center - points
+        view_dir = view_vec / (view_vec.norm(dim=1,keepdim=True)+1e-4)
+        tex_norm = tex_vec.norm(dim=2)
+        if score_mode == "distance":
+            scores = 1/(torch.norm(tex_centers-viewpoint_camera.camera_center,dim=2)+0.05)
+        else:
+            scores = (tex_vec*view_dir.unsqueeze(1)).sum(dim=2) / (tex_norm+1e-4)**2
+
+        colors = self.colors.permute(1,2,0)
+        masks = self.visibility.T.unsqueeze(1)
+        colors, masks = blend_stack(blend_mode, colors, masks, scores.T.unsqueeze(1)*masks)
+        return colors.T, masks.T
+
+def sample_gaussian_textures(camera, uv, depth, jacobian, extent, shadowmap_tol=0.05, shadow_map_padding="zeros"):
+    """
+    Samples the colour and shadow map pyramids of camera at the texture coordinates of Gaussian centers. The colour
+    comes from the mip level where the footprint of the Gaussian, extent mapped through jacobian,
+    covers about one texel, the shadow test always uses the full resolution depth.
+    Returns the levels (N,), soft visibility (N,) and colours (N,3).
+    """
+    num_levels = len(camera.image_scales)
+    grid = uv.reshape((1,1,-1,2))
+
+    colors, target_depth = sample_rgbd(rgbd_texture(camera, 0).unsqueeze(0), grid, shadow_map_padding)
+    colors = colors[0,:,0].T.contiguous()
+    not_in_shadow = torch.exp(-(depth - target_depth[0,0,0])**2/shadowmap_tol**2)
+    in_frame = ((uv<1) & (uv>-1)).all(dim=1) & (depth>0)
+
+    pixel_scale = torch.tensor([camera.image_width/2, camera.image_height/2], device=uv.device)
+    footprint = (jacobian.norm(dim=2)*pixel_scale).amax(dim=1) * extent
+    levels = torch.clamp(torch.floor(torch.log2(torch.clamp(footprint,min=1))), 0, num_levels-1).to(torch.uint8)
+    for level in range(1, num_levels):
+        index = torch.nonzero(levels==level)[:,0]
+        if len(index) == 0:
+            continue
+        level_grid = uv[index].reshape((1,1,-1,2))
+        level_image = camera.image_scales[level].to(device=uv.device, dtype=torch.float32)
+        level_colors = torch.nn.functional.grid_sample(level_image.unsqueeze(0), level_grid, align_corners=False, padding_mode="border", mode='bicubic')[0,:,0]
+        colors[index] = level_colors.T
+
+    return levels, not_in_shadow*in_frame.float(), colors
+
+def textured_render_precomputed(viewpoint_camera, texture_coords, pc : GaussianModel, pipe, bg_color : torch.Tensor, blend_mode="scores2"):
+    """
+    Textured render from a GaussianTextureCoords: blends the precomputed per Gaussian colours for
+    viewpoint_camera and rasterizes them with a single render.
+    """
+    if not texture_coords.is_current(pc):
+        raise ValueError("The texture coordinates were precomputed for another version of the model")
+    blend_mode, score_mode = parse_blend_mode(blend_mode)
+
+    colors, masks = texture_coords.blend(viewpoint_camera, pc.get_xyz, blend_mode, score_mode)
+    render_pkg = render(viewpoint_camera, pc, pipe, bg_color, override_color=colors)
+
+    render_pkg["render_textured"] = render_pkg["render"]
+    render_pkg["render_textured_mask"] = (render_pkg["render_opacity"]>0.1).float()
+    return render_pkg
 
 def textured_render_per_gaussian(viewpoint_camera, texture_cameras, pc : GaussianModel, pipe, bg_color : torch.Tensor,in_training=False, texture_scale=0, blend_mode=None,num_texture_views=100):
     visible_texture_cameras = get_top_texture_cameras(viewpoint_camera,(pc,pipe,bg_color),texture_cameras,num_texture_views,in_training)
@@ -303,29 +1038,17 @@ def textured_render_per_gaussian(viewpoint_camera, texture_cameras, pc : Gaussia
     texture_colors = torch.stack(texture_colors)
     texture_masks = (torch.stack(texture_masks)).float()
 
-    blend_mode = "scores_softmax"
+    blend_mode = "scores_softmax" if blend_mode is None else parse_blend_mode(blend_mode)[0]
 
     render_textured_mask = 1 - torch.prod(1-texture_masks,dim=0)
-    if blend_mode=="alpha":
-        w = torch.zeros_like(texture_masks)
-        T = torch.ones_like(texture_masks[0])
-        
-        for i in range(len(visible_texture_cameras)):
-            w[i] = texture_masks[i] * T
-            T = T*(1-texture_masks[i])
-        
-        colors = (texture_colors*w).sum(dim=0)/(render_textured_mask+1e9)
-    else:
-        texture_scores = texture_masks/(torch.arange(2,len(texture_masks)+2,device=texture_masks.device).reshape((-1,1,1,1)))**0.5
-        texture_scores -= (texture_masks<1e-4)*100
-        
-        if blend_mode=="scores_softmax":
-            texture_scores = texture_scores#-texture_scores.min()
-            texture_scores = torch.exp(texture_scores*50)
-        else:
-            texture_scores = (texture_scores==(texture_scores.amax(dim=0).unsqueeze(0)))
-            
-        colors = (texture_colors * texture_scores).sum(dim=0) / (texture_scores.sum(dim=0)+1e-9)
+
+    # Closer cameras come first and win between equally visible ones
+    texture_scores = texture_masks/(torch.arange(2,len(texture_masks)+2,device=texture_masks.device).reshape((-1,1,1,1)))**0.5
+    texture_scores -= (texture_masks<1e-4)*100
+
+    blend_args = {"temperature": 50} if blend_mode == "scores_softmax" else {}
+    colors, _ = blend_stack(blend_mode, texture_colors.flatten(2), texture_masks.flatten(2), texture_scores.flatten(2), **blend_args)
+    colors = colors.reshape(texture_colors.shape[1:])
         
     render_textured = colors
     render_textured_mask = (render_textured_mask>0.2).float()
@@ -333,8 +1056,7 @@ def textured_render_per_gaussian(viewpoint_camera, texture_cameras, pc : Gaussia
     render_textured, render_textured_mask = blur_inpaint(render_textured, render_textured_mask,2)
     render_textured, render_textured_mask = blur_inpaint(render_textured, render_textured_mask,5)
     
-    return {
-        "render_textured": colors.reshape((3,viewpoint_camera.image_height,viewpoint_camera.image_width)),
-        "render_textured_mask": render_textured_mask.reshape((1,viewpoint_camera.image_height,viewpoint_camera.image_width)),
-        **render_pkg
-    }
\ No newline at end of file
+    render_pkg = render_pkg.copy()
+    render_pkg["render_textured"] = colors.reshape((3,viewpoint_camera.image_height,viewpoint_camera.image_width))
+    render_pkg["render_textured_mask"] = render_textured_mask.reshape((1,viewpoint_camera.image_height,viewpoint_camera.image_width))
+    return render_pkg
\ No newline at end of file
@@ -14,15 +14,17 @@ import time
 import torch
 from random import randint
 from depth_images import calibrate_depth, depth_smoothness_loss
-from textured_render import prerender_depth, textured_render_multicam
+from textured_render import build_visibility_index, prerender_depth, textured_render_multicam
 from utils.loss_utils import l1_loss, ssim, l2_loss
-from gaussian_renderer import render, network_gui
+from gaussian_renderer import render, render_batch, network_gui
 import sys
 from scene import Scene, GaussianModel
+from scene.camera_index import CameraIndex
 from utils.general_utils import safe_state
 import uuid
 from tqdm import tqdm
 from utils.image_utils import psnr
+from utils.texture_pyramid import build_scales
 from argparse import ArgumentParser, Namespace
 from arguments import ModelParams, PipelineParams, OptimizationParams
 
@@ -70,6 +72,8 @@ def training(
     iter_start = torch.cuda.Event(enable_timing=True)
     iter_end = torch.cuda.Event(enable_timing=True)
 
+    texture_camera_index = CameraIndex(scene.getTrainCameras())
+
     viewpoint_stack = None
     ema_loss_for_log = 0.0
     ema_loss_depth_for_log = 0.0
@@ -131,7 +135,7 @@ def training(
         #         viewpoint_cam = camera
         
         # viewpoint_cam = selected_cameras[iteration%len(selected_cameras)]
-        selected_cameras = scene.getTrainCameras()
+        selected_cameras = texture_camera_index
         # print(viewpoint_cam.colmap_id)
         
         # Render
@@ -158,7 +162,8 @@ def training(
                 in_training=True,
                 texture_scale=scale,#(3-(iteration//600)),
                 blend_mode="scores_softmax2",#"scores_softmax"
-                num_texture_views=8
+                num_texture_views=8,
+                return_stacks=True
             )
             
             if iteration==1:
@@ -181,7 +186,10 @@ def training(
             render_pkg["render_depth"].retain_grad()
             #render_pkg["render"].retain_grad()
 
+            # Targets are downsampled from the float32 image when the texture pyramid is quantized
             gt_image_rz = viewpoint_cam.image_scales[scale]
+            if gt_image_rz.dtype != torch.float32:
+                gt_image_rz = build_scales(viewpoint_cam.original_image.cuda(), scale)[-1]
             #gt_image_rz = viewpoint_cam.image_scales[0]
             
             images = torch.nn.functional.interpolate(images, (gt_image_rz.shape[1],gt_image_rz.shape[2]), mode='area')
@@ -191,7 +199,7 @@ def training(
             image = render_pkg["render_textured"]
             
             gt_image_rz = gt_image_rz.unsqueeze(0)
-            gt_image = viewpoint_cam.image_scales[0]
+            gt_image = viewpoint_cam.original_image.cuda()
             
             full_photo = l1_loss((image)[:,:,:], (gt_image)[:,:,:])
                 
@@ -336,7 +344,7 @@ def training(
                 iter_start.elapsed_time(iter_end),
                 testing_iterations,
                 scene,
-                render,
+                render_batch,
                 (pipe, background),
             )
 
@@ -373,11 +381,18 @@ def training(
                     size_threshold = (
                         20 if iteration > opt.opacity_reset_interval else None
                     )
+                    if opt.min_views > 0 and (
+                        gaussians.visibility_index is None
+                        or iteration % opt.visibility_index_interval < opt.densification_interval
+                    ):
+                        # Densification keeps the index in step, optimizer moves need a rebuild
+                        build_visibility_index(gaussians, scene.getTrainCameras(), pipe, background)
                     gaussians.densify_and_prune(
                         opt.densify_grad_threshold,
                         0.005,
                         scene.cameras_extent,
                         size_threshold,
+                        opt.min_views,
                     )
 
                 if (
@@ -391,6 +406,7 @@ def training(
             if iteration < opt.iterations:
                 gaussians.optimizer.step()
                 gaussians.optimizer.zero_grad(set_to_none=True)
+                gaussians.bump_version()
 
             if iteration in checkpoint_iterations:
                 print("\n[ITER {}] Saving Checkpoint".format(iteration))
@@ -459,12 +475,9 @@ def training_report(
             if config["cameras"] and len(config["cameras"]) > 0:
                 l1_test = 0.0
                 psnr_test = 0.0
-                for idx, viewpoint in enumerate(config["cameras"]):
-                    image = torch.clamp(
-                        renderFunc(viewpoint, scene.gaussians, *renderArgs)["render"],
-                        0.0,
-                        1.0,
-                    )
+                render_pkgs = renderFunc(config["cameras"], scene.gaussians, *renderArgs)
+                for idx, (viewpoint, render_pkg) in enumerate(zip(config["cameras"], render_pkgs)):
+                    image = torch.clamp(render_pkg["render"], 0.0, 1.0)
                     gt_image = torch.clamp(
                         viewpoint.original_image.to("cuda"), 0.0, 1.0
                     )
@@ -0,0 +1,103 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import torch
+from collections import OrderedDict
+from utils.texture_pyramid import build_packed_scales
+
+class DepthCache:
+    """
+    LRU cache of texture camera shadow maps. Each entry is the packed rendered depth pyramid
+    of a camera, with as many levels as its colour pyramid and stored in the same dtype.
+
+    Entries are keyed by camera and are only valid for the GaussianModel version
+    they were rendered with. Depth rendered with gradients enabled is never cached,
+    since the renders of each training iteration are part of that iteration's graph.
+    """
+    def __init__(self, memory_budget_mb=2048):
+        self.memory_budget_mb = memory_budget_mb
+        self.entries = OrderedDict()
+        self.memory = 0
+        self.model_key = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def camera_key(camera):
+        # Train and test camera uids both start at 0
+        return (camera.split, camera.uid)
+
+    @staticmethod
+    def entry_size(depth_scales):
+        return sum(level.numel() * level.element_size() for level in depth_scales)
+
+    def clear(self):
+        self.entries.clear()
+        self.memory = 0
+
+    def get(self, camera, pc, render_depth):
+        """
+        Returns the depth pyramid of camera, calling render_depth(camera) on a miss.
+        """
+        return self.get_many([camera], pc, lambda cameras: [render_depth(cam) for cam in cameras])[0]
+
+    def get_many(self, cameras, pc, render_depths):
+        """
+        Returns the depth pyramids of cameras. The depth of all misses is rendered by one
+        render_depths(cameras) call, which may return any iterable of depth maps.
+        """
+        cameras = list(cameras)
+        depth_scales = [None] * len(cameras)
+        caching = self.memory_budget_mb > 0 and not torch.is_grad_enabled()
+
+        if caching:
+            model_key = (id(pc), pc.version)
+            if model_key != self.model_key:
+                self.clear()
+                self.model_key = model_key
+
+            for i, camera in enumerate(cameras):
+                key = self.camera_key(camera)
+                if key in self.entries:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    depth_scales[i] = self.entries[key]
+
+        missing = [i for i in range(len(cameras)) if depth_scales[i] is None]
+        self.misses += len(missing)
+        for i, depth in zip(missing, render_depths([cameras[i] for i in missing])):
+            # Depth rendered with gradients stays float32, it is part of the iteration's graph
+            dtype = cameras[i].image_scales[0].dtype if caching else None
+            depth_scales[i] = build_packed_scales(depth, len(cameras[i].image_scales)-1, dtype)
+            if caching:
+                self.entries[self.camera_key(cameras[i])] = depth_scales[i]
+                self.memory += self.entry_size(depth_scales[i])
+                self.evict()
+        return depth_scales
+
+    def evict(self):
+        # The most recently inserted entry is always kept, even if it alone exceeds the budget
+        while self.memory > self.memory_budget_mb * 1024**2 and len(self.entries) > 1:
+            _, depth_scales = self.entries.popitem(last=False)
+            self.memory -= self.entry_size(depth_scales)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "entries": len(self.entries),
+            "memory_mb": self.memory / 1024**2,
+        }
@@ -112,6 +112,44 @@ def build_scaling_rotation(s, r):
     L = R @ L
     return L
 
+def compile_if_available(function, **kwargs):
+    """
+    function compiled with torch.compile, or function itself when torch.compile is not
+    available (PyTorch < 2.0). If compilation fails on a call, it runs eagerly from then on.
+    """
+    if not hasattr(torch, "compile"):
+        return function
+    compiled = torch.compile(function, **kwargs)
+    eager = False
+
+    def wrapper(*args, **kwargs):
+        nonlocal eager
+        if not eager:
+            try:
+                return compiled(*args, **kwargs)
+            except Exception as e:
+                print(f"[Warning] torch.compile of {function.__name__} failed, running eagerly: {e}")
+                eager = True
+        return function(*args, **kwargs)
+
+    wrapper.__name__ = function.__name__
+    return wrapper
+
+# Elementwise kernels run through torch.compile once enable_compiled_kernels() was called
+use_compiled_kernels = False
+compiled_kernels = {}
+
+def enable_compiled_kernels(enabled=True):
+    global use_compiled_kernels
+    use_compiled_kernels = enabled
+
+def kernel(function):
+    if not use_compiled_kernels:
+        return function
+    if function not in compiled_kernels:
+        compiled_kernels[function] = compile_if_available(function)
+    return compiled_kernels[function]
+
 def safe_state(silent,seed=0):
     old_f = sys.stdout
     class F:
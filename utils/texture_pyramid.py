@@ -0,0 +1,41 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import torch
+
+def pack_levels(levels, dtype=None):
+    """
+    Copies the (C,H,W) levels of a pyramid into one contiguous allocation, in dtype or in the
+    dtype of the levels, and returns views of it, one per level.
+    """
+    dtype = levels[0].dtype if dtype is None else dtype
+    storage = torch.empty(sum(level.numel() for level in levels), dtype=dtype, device=levels[0].device)
+    packed = []
+    offset = 0
+    for level in levels:
+        view = storage[offset:offset+level.numel()].view(level.shape)
+        view.copy_(level)
+        packed.append(view)
+        offset += level.numel()
+    return packed
+
+def build_scales(image, num_scales=5):
+    scales = [image]
+    for _ in range(num_scales):
+        scales.append(torch.nn.functional.interpolate(scales[-1].unsqueeze(0),scale_factor=0.5,mode="area")[0])
+    return scales
+
+def build_packed_scales(image, num_scales=5, dtype=None):
+    """
+    Area downsampled pyramid of image with num_scales levels below it, in one allocation.
+    Levels are downsampled in the precision of image and then stored in dtype.
+    """
+    return pack_levels(build_scales(image, num_scales), dtype)
@@ -17,7 +17,7 @@ import os
 from tqdm import tqdm
 from os import makedirs
 from gaussian_renderer import render
-from textured_render import prerender_depth, textured_render_multicam, textured_render_per_gaussian
+from textured_render import CameraPathState, enable_compiled_kernels, prerender_depth, textured_render_multicam, textured_render_per_gaussian
 import torchvision
 from utils.general_utils import safe_state
 from argparse import ArgumentParser
@@ -26,11 +26,12 @@ from gaussian_renderer import GaussianModel
 import cv2
 import numpy as np
 from scene.cameras import MiniCam
+from scene.camera_index import CameraIndex
 import math
 import glm
 import copy
 
-def render_sets(dataset : ModelParams, iteration : int, pipeline : PipelineParams, output:Path,blend_mode, render_type):
+def render_sets(dataset : ModelParams, iteration : int, pipeline : PipelineParams, output:Path,blend_mode, render_type, path_translation_threshold, path_rotation_threshold):
     with torch.no_grad():
         gaussians = GaussianModel(dataset.sh_degree)
         scene = Scene(dataset, gaussians, load_iteration=iteration, shuffle=False)
@@ -42,6 +43,13 @@ def render_sets(dataset : ModelParams, iteration : int, pipeline : PipelineParam
 
         prerender_depth(scene.getTrainCameras(), gaussians, pipeline, background)
 
+        texture_cameras = CameraIndex(scene.getTrainCameras())
+        # Reusing texture camera selections along the path is opt-in, the textures it keeps
+        # resident count against pipeline.depth_cache_mb
+        path_state = None
+        if path_translation_threshold > 0 or path_rotation_threshold > 0:
+            path_state = CameraPathState(path_translation_threshold, path_rotation_threshold)
+
         view = copy.deepcopy(scene.getTrainCameras()[0])
         radius = np.linalg.norm(view.camera_center.cpu())
         for i in tqdm(range(200)):
@@ -58,11 +66,13 @@ def render_sets(dataset : ModelParams, iteration : int, pipeline : PipelineParam
             
             rendering_pkg = textured_render_multicam(
                 view,
-                scene.getTrainCameras(),
+                texture_cameras,
                 gaussians,
                 pipeline,
                 background,
-                blend_mode=blend_mode
+                blend_mode=blend_mode,
+                outputs=["render_textured"],
+                path_state=path_state
             )
             
             #rendering_pkg = textured_render_per_gaussian(view, scene.getTrainCameras(),gaussians, pipeline, background,in_training=False)
@@ -70,6 +80,9 @@ def render_sets(dataset : ModelParams, iteration : int, pipeline : PipelineParam
                 rendering_pkg["render_textured"],
                 output/f"{i}.png"
             )
+
+        if path_state is not None:
+            print("Camera path:", path_state.stats())
             
 
 if __name__ == "__main__":
@@ -83,6 +96,9 @@ if __name__ == "__main__":
     parser.add_argument("--textured_render", action="store_true")
     parser.add_argument("--inpaint", action="store_true")
     parser.add_argument("--output", type=Path)
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument("--path_translation_threshold", default=0, type=float)
+    parser.add_argument("--path_rotation_threshold", default=0, type=float)
     
     args = get_combined_args(parser)
     print("Rendering " + args.model_path)
@@ -93,5 +109,6 @@ if __name__ == "__main__":
 
     # Initialize system state (RNG)
     safe_state(args.quiet)
+    enable_compiled_kernels(args.compile)
 
-    render_sets(model.extract(args), args.iteration, pipeline.extract(args), args.output, args.blend_mode, render_type)
\ No newline at end of file
+    render_sets(model.extract(args), args.iteration, pipeline.extract(args), args.output, args.blend_mode, render_type, args.path_translation_threshold, args.path_rotation_threshold)
\ No newline at end of file